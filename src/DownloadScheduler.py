@@ -0,0 +1,93 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from Metrics import metrics
+from utils import ByteProgress
+
+
+class DownloadScheduler:
+    """ Runs downloads smallest first, with files of at least big_file_size bytes on their own workers so they do not
+    hold back the small ones. Google files have no size and are exported first. New downloads are not started once the
+    byte or time budget of the run is spent, and the files left are returned to be downloaded by the next run """
+
+    def __init__(self, workers=1, big_workers=1, big_file_size=100 * 1024 * 1024, byte_budget=None,
+                 time_budget_s=None):
+        self.workers = workers
+        self.big_workers = big_workers
+        self.big_file_size = big_file_size
+        self.byte_budget = byte_budget
+        self.time_budget_s = time_budget_s
+
+    def run(self, files, job, progress_msg='Progress', complete_msg='Done'):
+        """ Calls job(file, progress) for each file, where progress(n) reports n bytes received. job returns a list
+        of fails. Returns the fails of all jobs and the files that were not started """
+        small, big = self.__split(files)
+        progress = ByteProgress(files, progress_msg, complete_msg)
+        fails = []
+        started = time.time()
+        scheduled = 0  # Bytes of the files started
+        count = 0
+
+        def task(file):
+            received = [0]
+
+            def update(n):
+                received[0] += n
+                progress.update(file, n)
+
+            t_begin = time.monotonic()
+            try:
+                return job(file, update)
+            finally:
+                progress.done(file)
+                metrics.download(file.make_relative_path(), file.mime_type, received[0], time.monotonic() - t_begin)
+
+        def next_file(queues):
+            # Queues are sorted by size, so if the first file does not fit in the budget the following ones neither
+            if self.time_budget_s is not None and time.time() - started > self.time_budget_s:
+                return None
+            queue = next((q for q in queues if q), None)
+            if not queue:
+                return None
+            size = queue[0].size or 0
+            # A file bigger than the whole budget is only started by a run with nothing smaller to download
+            if self.byte_budget is not None and count and scheduled + size > self.byte_budget:
+                return None
+            return queue.popleft()
+
+        pools = [(ThreadPoolExecutor(max_workers=self.workers), self.workers, (small, big))]
+        if self.big_workers:
+            pools.append((ThreadPoolExecutor(max_workers=self.big_workers), self.big_workers, (big,)))
+        running = {}
+        try:
+            while True:
+                for pool, limit, queues in pools:
+                    while sum(1 for p in running.values() if p is pool) < limit:
+                        file = next_file(queues)
+                        if file is None:
+                            break
+                        scheduled += file.size or 0
+                        count += 1
+                        running[pool.submit(task, file)] = pool
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running.pop(future)
+                    fails.extend(future.result())
+        finally:
+            for pool, _, _ in pools:
+                pool.shutdown()
+        progress.close()
+
+        metrics.count('downloaded_bytes', progress.bytes_done)
+        return fails, list(small) + list(big)
+
+    # Private ----------------------------------------------------------------------------------------------------------
+
+    def __split(self, files):
+        ordered = sorted(files, key=lambda file: file.size or 0)
+        small = deque(f for f in ordered if (f.size or 0) < self.big_file_size)
+        big = deque(f for f in ordered if (f.size or 0) >= self.big_file_size)
+        return small, big
@@ -0,0 +1,430 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+
+from GDriveAPI import GMimeTypes, EXPORT_MIME_TYPES
+
+QUERY_TOKENS = re.compile(r"\s*(\(|\)|'(?:[^'\\]|\\.)*'|!=|=|[A-Za-z]+)")
+ERROR_REASONS = {403: 'userRateLimitExceeded', 416: 'requestedRangeNotSatisfiable', 429: 'rateLimitExceeded',
+                 500: 'backendError'}
+STATUS_REASONS = {200: 'OK', 206: 'Partial Content', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+                  416: 'Requested Range Not Satisfiable', 429: 'Too Many Requests', 500: 'Internal Server Error'}
+
+
+class FakeDrive:
+    """ Local stand-in for the Drive v3 endpoints used by GDriveAPI: files list (with the queries of this project),
+    get, media downloads with ranges, exports, export links, revisions, changes and batches. Requests can be delayed
+    (latency_s, bytes_per_s) and fail at random with the statuses in errors (i.e. {429: 0.01, 500: 0.01}) """
+
+    ROOT_ID = 'fake-my-drive'
+
+    def __init__(self, latency_s=0, errors=None, bytes_per_s=None, retry_after=None, seed=0, port=0):
+        self.latency_s = latency_s
+        self.errors = errors or {}
+        self.bytes_per_s = bytes_per_s
+        self.retry_after = retry_after
+        self.files = {}
+        self.requests = Counter()  # By endpoint
+        self.__versions = {}
+        self.__children = defaultdict(set)
+        self.__changes = []  # Changed file ids, oldest first
+        self.__listings = {}  # Results of listings being paged, by id
+        self.__clock = datetime(2020, 1, 1)
+        self.__random = random.Random(seed)
+        self.__lock = threading.RLock()
+        self.__server = FakeDriveServer(('127.0.0.1', port), FakeDriveHandler)
+        self.__server.drive = self
+        self.__thread = None
+
+    @property
+    def root_url(self):
+        return 'http://127.0.0.1:%d/' % self.__server.server_address[1]
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # Drive contents ---------------------------------------------------------------------------------------------------
+
+    def add(self, name, mime_type, parent=None, size=0, gid=None):
+        """ Adds a file (with content of size bytes) or folder and returns its metadata """
+        with self.__lock:
+            gid = gid or '%016x' % self.__random.getrandbits(64)
+            now = self.__now()
+            data = {'id': gid, 'name': name, 'mimeType': mime_type, 'trashed': False, 'createdTime': now,
+                    'modifiedTime': now, 'parents': [parent or self.ROOT_ID]}
+            if GMimeTypes.GPREFIX.value not in mime_type:
+                data['size'] = str(size)
+            self.files[gid] = data
+            self.__versions[gid] = 0
+            self.__children[data['parents'][0]].add(gid)
+            self.__update_content(gid)
+            return data
+
+    def modify(self, gid):
+        """ New content version of a file """
+        with self.__lock:
+            self.__versions[gid] += 1
+            self.files[gid]['modifiedTime'] = self.__now()
+            self.__update_content(gid)
+
+    def move(self, gid, parent=None, name=None):
+        with self.__lock:
+            data = self.files[gid]
+            if parent:
+                self.__children[data['parents'][0]].discard(gid)
+                self.__children[parent].add(gid)
+                data['parents'] = [parent]
+            if name:
+                data['name'] = name
+            self.__changes.append(gid)
+
+    def remove(self, gid):
+        """ Deletes a file or a folder with its contents """
+        with self.__lock:
+            data = self.files.pop(gid)
+            self.__children[data['parents'][0]].discard(gid)
+            for child in list(self.__children.pop(gid, ())):
+                self.remove(child)
+            self.__changes.append(gid)
+
+    def populate(self, n, root_name='root', depth=5, files_per_folder=20, docs_ratio=0.1, max_size=16 * 1024):
+        """ Synthetic tree of n nodes under a root folder at the top of My Drive, with folders nested up to depth
+        levels. Returns the id of the root folder """
+        root = self.add(root_name, GMimeTypes.GFOLDER.value)['id']
+        levels = [[root]]
+        for i in range(1, n):
+            if i % files_per_folder == 0:
+                level = self.__random.randrange(min(len(levels), depth))
+                gid = self.add('dir%d' % i, GMimeTypes.GFOLDER.value, self.__random.choice(levels[level]))['id']
+                if level + 1 == len(levels):
+                    levels.append([])
+                levels[level + 1].append(gid)
+            elif self.__random.random() < docs_ratio:
+                self.add('doc%d' % i, GMimeTypes.GDOCS.value, self.__random.choice(self.__random.choice(levels)))
+            else:
+                self.add('file%d.bin' % i, 'application/octet-stream',
+                         self.__random.choice(self.__random.choice(levels)), self.__random.randrange(max_size))
+        return root
+
+    def mutate(self, ratio=0.01):
+        """ Modifies, removes and adds a fraction of the files """
+        with self.__lock:
+            files = [gid for gid, data in self.files.items() if data['mimeType'] != GMimeTypes.GFOLDER.value]
+            folders = [gid for gid, data in self.files.items() if data['mimeType'] == GMimeTypes.GFOLDER.value]
+            count = max(1, int(len(files) * ratio))
+            sample = self.__random.sample(files, 2 * count)
+            for gid in sample[:count]:
+                self.modify(gid)
+            for gid in sample[count:]:
+                self.remove(gid)
+            for i in range(count):
+                self.add('new%d.bin' % i, 'application/octet-stream', self.__random.choice(folders), 1024)
+
+    def move_folders(self, ratio=0.5):
+        """ Moves a fraction of the folders below the root folders into a new folder, as a reorganization would """
+        with self.__lock:
+            roots = [gid for gid, data in self.files.items() if data['parents'] == [self.ROOT_ID]]
+            folders = [gid for root in roots for gid in self.__children[root]
+                       if self.files[gid]['mimeType'] == GMimeTypes.GFOLDER.value]
+            for root in roots:
+                target = self.add('moved', GMimeTypes.GFOLDER.value, root)['id']
+                for gid in folders[:int(len(folders) * ratio)]:
+                    if self.files[gid]['parents'] == [root]:
+                        self.move(gid, target)
+
+    def content(self, gid, export_format=None):
+        """ Deterministic content of the current version of a file or of one of its exports """
+        seed = ('%s:%d:%s:' % (gid, self.__versions[gid], export_format or '')).encode()
+        size = int(self.files[gid]['size']) if export_format is None else 1024
+        return (seed * (size // len(seed) + 1))[:size]
+
+    def children(self, gid):
+        return list(self.__children.get(gid, ()))
+
+    # Endpoints --------------------------------------------------------------------------------------------------------
+
+    def handle(self, method, url, headers, body=b''):
+        """ Returns (status, headers, body) of a request, which is counted under its endpoint name """
+        parts = urlsplit(url)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        path = parts.path.strip('/').split('/')
+
+        if method == 'POST' and parts.path == '/batch/drive/v3':
+            return self.__batch(headers, body)
+        if path[:2] != ['drive', 'v3']:
+            if 'id' in query and 'exportFormat' in query:
+                return self.__endpoint('export_link', lambda: self.__export(query['id'], query['exportFormat']))
+            return self.__error(404, 'notFound')
+        path = path[2:]
+        if path == ['files']:
+            return self.__endpoint('files.list', lambda: self.__list(query))
+        if path == ['changes', 'startPageToken']:
+            return self.__endpoint('changes.getStartPageToken',
+                                   lambda: self.__json({'startPageToken': str(len(self.__changes))}))
+        if path == ['changes']:
+            return self.__endpoint('changes.list', lambda: self.__list_changes(query))
+        if len(path) == 2 and path[0] == 'files' and query.get('alt', None) == 'media':
+            size = self.files.get(path[1], {}).get('size', None)
+            return self.__endpoint('files.get_media', lambda: self.__media(path[1], headers.get('range', None)),
+                                   int(size) if size and 'range' in headers else None)
+        if len(path) == 2 and path[0] == 'files':
+            return self.__endpoint('files.get', lambda: self.__get(path[1]))
+        if len(path) == 3 and path[2] == 'export':
+            return self.__endpoint('files.export', lambda: self.__export(path[1], query.get('mimeType', None)))
+        if len(path) == 3 and path[2] == 'revisions':
+            return self.__endpoint('revisions.list', lambda: self.__revisions(path[1]))
+        return self.__error(404, 'notFound')
+
+    # Private ----------------------------------------------------------------------------------------------------------
+
+    def __now(self):
+        # Every change gets a later time
+        self.__clock += timedelta(seconds=1)
+        return self.__clock.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    def __update_content(self, gid):
+        data = self.files[gid]
+        if 'size' in data:
+            data['md5Checksum'] = hashlib.md5(self.content(gid)).hexdigest()
+            data['headRevisionId'] = 'rev%d' % self.__versions[gid]
+        self.__changes.append(gid)
+
+    def __endpoint(self, name, function, range_size=None):
+        self.requests[name] += 1
+        for status, probability in self.errors.items():
+            # Range errors only make sense for ranged downloads of files with content
+            if (status != 416 or range_size) and self.__random.random() < probability:
+                status, headers, body = self.__error(status, ERROR_REASONS.get(status, 'injected'))
+                if status == 416:
+                    headers['Content-Range'] = 'bytes */%d' % range_size
+                return status, headers, body
+        with self.__lock:
+            return function()
+
+    def __error(self, status, reason):
+        headers = {'Content-Type': 'application/json'}
+        if status == 429 and self.retry_after is not None:
+            headers['Retry-After'] = str(self.retry_after)
+        body = {'error': {'code': status, 'message': reason, 'errors': [{'reason': reason, 'message': reason}]}}
+        return status, headers, json.dumps(body).encode()
+
+    @staticmethod
+    def __json(data):
+        return 200, {'Content-Type': 'application/json'}, json.dumps(data).encode()
+
+    def __get(self, gid):
+        if gid == 'root':
+            return self.__json({'id': self.ROOT_ID})
+        if gid not in self.files:
+            return self.__error(404, 'notFound')
+        return self.__json(self.files[gid])
+
+    def __list(self, query):
+        page_size = min(int(query.get('pageSize', 100)), 1000)
+        if 'pageToken' in query:
+            listing_id, offset = query['pageToken'].rsplit(':', 1)
+            files, offset = self.__listings[listing_id], int(offset)
+        else:
+            listing_id, offset = uuid.uuid4().hex, 0
+            files = self.__query(query.get('q', ''))
+            self.__listings[listing_id] = files
+        response = {'files': files[offset:offset + page_size]}
+        if offset + page_size < len(files):
+            response['nextPageToken'] = '%s:%d' % (listing_id, offset + page_size)
+        else:
+            del self.__listings[listing_id]
+        return self.__json(response)
+
+    def __query(self, q):
+        tokens = QUERY_TOKENS.findall(q)
+        if not tokens:
+            return list(self.files.values())
+        node, position = FakeDrive.__parse_or(tokens, 0)
+        if position != len(tokens):
+            raise ValueError('Unsupported query %s' % q)
+        candidates = self.__candidates(node)
+        if candidates is None:
+            candidates = self.files.keys()
+        return [self.files[gid] for gid in candidates if gid in self.files and self.__matches(node, self.files[gid])]
+
+    def __candidates(self, node):
+        # Files of 'in parents' conditions are taken from the children index instead of checking every file
+        if node[0] == 'parents':
+            return self.__children.get(node[1], set())
+        if node[0] == 'or':
+            sets = [self.__candidates(n) for n in node[1]]
+            return set().union(*sets) if all(s is not None for s in sets) else None
+        if node[0] == 'and':
+            return next((s for s in (self.__candidates(n) for n in node[1]) if s is not None), None)
+        return None
+
+    def __matches(self, node, data):
+        kind = node[0]
+        if kind == 'or':
+            return any(self.__matches(n, data) for n in node[1])
+        if kind == 'and':
+            return all(self.__matches(n, data) for n in node[1])
+        if kind == 'not':
+            return not self.__matches(node[1], data)
+        if kind == 'parents':
+            return node[1] in data.get('parents', ())
+        _, field, operator, value = node
+        actual = data.get(field, None)
+        if operator == 'contains':
+            return value in actual
+        return (actual == value) == (operator == '=')
+
+    @staticmethod
+    def __parse_or(tokens, i):
+        items = []
+        while True:
+            node, i = FakeDrive.__parse_and(tokens, i)
+            items.append(node)
+            if i < len(tokens) and tokens[i] == 'or':
+                i += 1
+            else:
+                return (items[0] if len(items) == 1 else ('or', items)), i
+
+    @staticmethod
+    def __parse_and(tokens, i):
+        items = []
+        while True:
+            node, i = FakeDrive.__parse_factor(tokens, i)
+            items.append(node)
+            if i < len(tokens) and tokens[i] == 'and':
+                i += 1
+            else:
+                return (items[0] if len(items) == 1 else ('and', items)), i
+
+    @staticmethod
+    def __parse_factor(tokens, i):
+        if tokens[i] == 'not':
+            node, i = FakeDrive.__parse_factor(tokens, i + 1)
+            return ('not', node), i
+        if tokens[i] == '(':
+            node, i = FakeDrive.__parse_or(tokens, i + 1)
+            return node, i + 1
+        if tokens[i].startswith("'") and tokens[i + 1:i + 3] == ['in', 'parents']:
+            return ('parents', FakeDrive.__unquote(tokens[i])), i + 3
+        field, operator, value = tokens[i:i + 3]
+        value = FakeDrive.__unquote(value) if value.startswith("'") else value == 'true'
+        return ('compare', field, operator, value), i + 3
+
+    @staticmethod
+    def __unquote(token):
+        return re.sub(r"\\(.)", r'\1', token[1:-1])
+
+    def __media(self, gid, range_header):
+        if gid not in self.files or 'size' not in self.files[gid]:
+            return self.__error(404, 'notFound')
+        content = self.content(gid)
+        if not range_header:
+            return 200, {'Content-Type': 'application/octet-stream'}, content
+        start, end = range_header.split('=')[1].split('-')
+        start, end = int(start), min(int(end), len(content) - 1) if end else len(content) - 1
+        if start >= len(content):
+            return 416, {'Content-Range': 'bytes */%d' % len(content)}, b''
+        return 206, {'Content-Type': 'application/octet-stream',
+                     'Content-Range': 'bytes %d-%d/%d' % (start, end, len(content))}, content[start:end + 1]
+
+    def __export(self, gid, export_format):
+        if gid not in self.files or 'size' in self.files[gid]:
+            return self.__error(404, 'notFound')
+        extension = next((e for e, m in EXPORT_MIME_TYPES.items() if m == export_format), export_format)
+        if extension not in EXPORT_MIME_TYPES:
+            return self.__error(400, 'badRequest')
+        return 200, {'Content-Type': EXPORT_MIME_TYPES[extension]}, self.content(gid, extension)
+
+    def __revisions(self, gid):
+        if gid not in self.files:
+            return self.__error(404, 'notFound')
+        return self.__json({'revisions': [{'id': 'rev%d' % v} for v in range(self.__versions[gid] + 1)]})
+
+    def __list_changes(self, query):
+        start = int(query['pageToken'])
+        end = start + int(query.get('pageSize', 100))
+        changes = []
+        for gid in self.__changes[start:end]:
+            if gid in self.files:
+                changes.append({'fileId': gid, 'removed': False, 'file': self.files[gid]})
+            else:
+                changes.append({'fileId': gid, 'removed': True})
+        response = {'changes': changes}
+        if end < len(self.__changes):
+            response['nextPageToken'] = str(end)
+        else:
+            response['newStartPageToken'] = str(len(self.__changes))
+        return self.__json(response)
+
+    def __batch(self, headers, body):
+        # Each part is a serialized request, answered by a part with the serialized response
+        self.requests['batch'] += 1
+        message = BytesParser().parsebytes(b'Content-Type: ' + headers['content-type'].encode() + b'\r\n\r\n' + body)
+        boundary = 'batch_%s' % uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            request_line = part.get_payload().split('\n', 1)[0]
+            method, url, _ = request_line.split(' ', 2)
+            status, item_headers, item_body = self.handle(method, url, {})
+            parts.append('--%s\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\n'
+                         'HTTP/1.1 %d %s\r\nContent-Type: %s\r\n\r\n%s\r\n'
+                         % (boundary, part['Content-ID'][1:-1], status, STATUS_REASONS.get(status, 'Error'),
+                            item_headers.get('Content-Type', 'application/json'), item_body.decode()))
+        parts.append('--%s--\r\n' % boundary)
+        return 200, {'Content-Type': 'multipart/mixed; boundary=%s' % boundary}, ''.join(parts).encode()
+
+
+class FakeDriveServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which Nagle's algorithm would delay on kept alive connections
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.__respond(b'')
+
+    def do_POST(self):
+        self.__respond(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+    def log_message(self, format, *args):
+        pass
+
+    def __respond(self, body):
+        drive = self.server.drive
+        if drive.latency_s:
+            time.sleep(drive.latency_s)
+        headers = {k.lower(): v for k, v in self.headers.items()}
+        status, response_headers, content = drive.handle(self.command, self.path, headers, body)
+        if drive.bytes_per_s:
+            time.sleep(len(content) / drive.bytes_per_s)
+        self.send_response(status, STATUS_REASONS.get(status, 'Error'))
+        for key, value in response_headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
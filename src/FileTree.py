@@ -1,79 +1,185 @@
 import pickle
 import shutil
+from collections import defaultdict
 from datetime import datetime
 from pathlib import Path
 
 from apiclient import errors
 
+from DownloadScheduler import DownloadScheduler
 from FileTreeNode import FileTreeNode as Node
-from utils import recursive_rmdir_parents, file_op_decorator
+from GDriveAPI import GMimeTypes, EXPORT_MIME_TYPES, atomic_write
+from Metrics import metrics
+from RevisionStore import RevisionStore
+from utils import file_op_decorator, remove_empty_dirs, scan_dir
+
+
+class TreeSnapshot:
+    """ Copies of some nodes of a tree taken before changing it in place, with the part of the TreeStore interface used
+    by FileTree.diff. Its length is the one of the whole tree """
+
+    def __init__(self, nodes, size):
+        self.all_files = []
+        self.all_folders = []
+        for node in nodes:
+            (self.all_folders if node.mime_type == GMimeTypes.GFOLDER.value else self.all_files).append(node)
+        self.__size = size
+
+    def __len__(self):
+        return self.__size
 
 
 class FileTree:
 
-    def __init__(self, files=None, root_folder=None):
-        if files is None:
-            files = []
+    def __init__(self, files=None, root_folder=None, pages=None):
+        """ Tree of the files data (json) returned by the Drive API, given as a list or as an iterable of pages. Pages
+        are converted into nodes as they are consumed, so the whole listing is never held in memory """
+        if pages is None:
+            pages = [files] if files else []
         self.all_nodes = []
         self.all_files = []
         self.all_folders = []
         self.roots = []
-        self.__build(files, root_folder)
+        self.index = {}
+        self.__build(pages, root_folder)
 
-    def update_dir(self, new_tree, api, backup_dir, revisions_dir):
-        # Calculate diffs
-        to_download, to_revision, to_move = FileTree.diff(old_files=self.all_files, new_files=new_tree.all_files)
+    def __len__(self):
+        return len(self.all_nodes)
 
-        # Check that current backup state is consistent
-        missing, modified = self.__check_backup_consistency(backup_dir, remote_files=new_tree.all_files)
+    def to_json(self):
+        return (node.to_json() for node in self.all_nodes)
+
+    @staticmethod
+    def update_dir(old_tree, new_tree, api, backup_dir, revisions_dir, scheduler=None, scan_workers=1,
+                   dedup_revisions=False, check_local=True, changed=None):
+        """ Update the backup from old_tree to new_tree. old_tree can also be a TreeStore snapshot. Without check_local,
+        the local backup is assumed to match old_tree and is not scanned. With changed, the nodes of new_tree changed by
+        FileTree.apply_changes, old_tree is the TreeSnapshot of their previous state and only they are updated """
+        changed_files = None if changed is None else [f for f in changed if f.is_file()]
+        # Calculate diffs
+        with metrics.phase('diff'):
+            to_download, to_revision, to_move = FileTree.diff(old_tree=old_tree, new_tree=new_tree,
+                                                              new_files=changed_files)
+        with metrics.phase('export_revisions'):
+            FileTree.skip_unchanged_exports(api, to_download, to_revision, to_move)
+
+        # Check that current backup state is consistent. The local files are only stat once, here
+        local = None
+        missing, modified = [], []
+        if check_local:
+            print('* Scanning local backup ...')
+            with metrics.phase('scan'):
+                local = scan_dir(backup_dir, scan_workers)
+            with metrics.phase('consistency'):
+                missing, modified = FileTree.__check_backup_consistency(old_tree, backup_dir, local,
+                                                                        remote_tree=new_tree)
         to_download.extend(missing)
         to_download.extend(modified)
         to_revision.extend(modified)
 
         # Print stats
-        print('- Elements in old tree (+dirs):  ', len(self.all_nodes))
+        print('- Elements in old tree (+dirs):  ', len(old_tree))
         print('- Elements in new tree (+dirs):  ', len(new_tree.all_nodes))
         print('- Elements to download:          ', len(to_download))
         print('- Elements to delete (revision): ', len(to_revision))
         print('- Elements moved not modified:   ', len(to_move))
+        metrics.count('old_tree_nodes', len(old_tree))
+        metrics.count('new_tree_nodes', len(new_tree.all_nodes))
+        metrics.count('files_missing', len(missing))
+        metrics.count('files_modified_locally', len(modified))
+        metrics.count('files_to_revise', len(to_revision))
+        metrics.count('files_to_move', len(to_move))
 
         # Update local backup
-        revision_dir = revisions_dir / Path(datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
-        FileTree.revise_files(backup_dir, revision_dir, to_revision)
-        FileTree.move_files(backup_dir, to_move)
-        FileTree.download_files(api, backup_dir, to_download)
-
-        # Update last modification time for each local file in the new tree
+        revision_name = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        revision_store = RevisionStore(revisions_dir) if dedup_revisions else None
+        with metrics.phase('revise'):
+            if revision_store:
+                revision_store.revise_files(backup_dir, revision_name, to_revision)
+            else:
+                FileTree.revise_files(backup_dir, revisions_dir / Path(revision_name), to_revision)
+        with metrics.phase('move'):
+            FileTree.move_files(backup_dir, to_move)
+
+        # Content already in the backup or in the revisions store is copied instead of downloaded
+        with metrics.phase('copy'):
+            to_download, to_copy, to_copy_after = FileTree.find_duplicates(backup_dir, new_tree, to_download,
+                                                                           revision_store)
+            copy_fails, copied_bytes = FileTree.copy_files(backup_dir, to_copy)
+        to_download.extend(copy_fails)
+        metrics.count('files_to_download', len(to_download))
+        with metrics.phase('download'):
+            deferred = FileTree.download_files(api, backup_dir, to_download, scheduler)
+        with metrics.phase('copy'):
+            # Copies of deferred files are deferred as well, and copies of failed downloads are downloaded instead
+            deferred_gids = {file.gid for file in deferred}
+            deferred.extend(file for file, source in to_copy_after if source.gid in deferred_gids)
+            to_copy_after = [(file, source) for file, source in to_copy_after if source.gid not in deferred_gids]
+            # Downloaded files have their local modification time
+            copy_after_fails, copied_after_bytes = FileTree.copy_files(
+                backup_dir, [(file, source) for file, source in to_copy_after if source.last_local_update is not None])
+            copy_after_fails.extend(file for file, source in to_copy_after if source.last_local_update is None)
+        if copy_after_fails:
+            with metrics.phase('download'):
+                deferred.extend(FileTree.download_files(api, backup_dir, copy_after_fails, scheduler))
+        # Partial downloads of files which are not pending anymore will never be resumed. Passes limited to the changed
+        # files do not know the other pending files, so they keep every partial download
+        if changed is None:
+            api.discard_partial_downloads(keep={file.gid for file in to_download + copy_after_fails})
+        renamed_bytes = sum(new.size or 0 for old, new in to_move if old.md5 and old.name != new.name)
+        print('- Bytes not downloaded (renamed %d, duplicated %d)' % (renamed_bytes, copied_bytes + copied_after_bytes))
+        if deferred:
+            print('- Elements deferred to next backup (budget spent): %d' % len(deferred))
+        metrics.count('renamed_bytes', renamed_bytes)
+        metrics.count('copied_bytes', copied_bytes + copied_after_bytes)
+        metrics.count('files_copied', len(to_copy) + len(to_copy_after) - len(copy_fails) - len(copy_after_fails))
+        metrics.count('files_deferred', len(deferred))
+
+        # Update last modification time for each local file in the new tree. Unchanged, downloaded and moved files
+        # already have it. Deferred files are left without it, so the next consistency check downloads them
         print('* Updating last modification time in new tree ...')
-        for file in new_tree.all_files:
-            try:
-                file.update_local_modified_time(backup_dir)
-            except FileNotFoundError:
-                print('- Error: Could not update modified time of %s' % file.make_relative_path(backup_dir))
+        deferred = {file.gid for file in deferred}
+        with metrics.phase('modified_times'):
+            for file in new_tree.all_files if changed_files is None else changed_files:
+                if file.last_local_update is None and file.gid not in deferred:
+                    if local is None:
+                        entry = FileTree.__stat(file.make_relative_path(backup_dir))
+                    else:
+                        entry = local.get(file.make_relative_path().as_posix(), None)
+                    if entry:
+                        file.last_local_update = entry[1]
+                    else:
+                        print('- Error: Could not update modified time of %s' % file.make_relative_path(backup_dir))
 
-    def __check_backup_consistency(self, base_dir, remote_files):
+    @staticmethod
+    def __check_backup_consistency(old_tree, base_dir, local, remote_tree):
         missing = []
         modified = []
 
-        for file in self.all_files:
+        for file in old_tree.all_files:
             path = file.make_relative_path(base_dir)
+            entry = local.get(file.make_relative_path().as_posix(), None)
 
-            if not path.exists():
+            if not entry:
                 # Add remote file to download
-                remote_index = file.find_in_list(remote_files)
+                remote_file = file.find_in(remote_tree.index)
                 print('- File not found in local backup. A new copy will be '
-                      'downloaded [%s] (%s).' % ('OK' if remote_index else 'NO COPY IN REMOTE', path))
-                if remote_index:
-                    remote_file = remote_files[remote_index]
+                      'downloaded [%s] (%s).' % ('OK' if remote_file else 'NO COPY IN REMOTE', path))
+                if remote_file:
+                    missing.append(remote_file)
+
+            elif any(p.as_posix() not in local for _, p in file.export_paths()[1:]):
+                # Formats added to the configuration are exported as well
+                remote_file = file.find_in(remote_tree.index)
+                if remote_file:
                     missing.append(remote_file)
 
-            elif path.stat().st_mtime != file.last_local_update:
+            elif entry[1] != file.last_local_update:
                 # Add remote file to download
-                remote_index = file.find_in_list(remote_files)
-                remote_file = remote_files[remote_index]
+                remote_file = file.find_in(remote_tree.index)
                 print('- File was unexpectedly modified in local backup. This file will be moved to revision and a '
-                      'new copy will be downloaded [%s] (%s).' % ('OK' if remote_index else 'NO COPY IN REMOTE', path))
-                if remote_index:
+                      'new copy will be downloaded [%s] (%s).' % ('OK' if remote_file else 'NO COPY IN REMOTE', path))
+                if remote_file:
                     modified.append(remote_file)
 
         if not missing and not modified:
@@ -84,27 +190,164 @@ class FileTree:
     # Static -----------------------------------------------------------------------------------------------------------
 
     @staticmethod
-    def saver(tree, path: Path):
-        path.parents[0].mkdir(parents=True, exist_ok=True)
-        pickle.dump(tree, path.open('wb'))
+    def loader(path: Path):
+        tree = pickle.load(path.open('rb'))
+        # Trees pickled by older versions do not carry the gid index
+        if not hasattr(tree, 'index'):
+            tree.index = {node.gid: node for node in tree.all_nodes}
+        return tree
 
     @staticmethod
-    def loader(path: Path):
-        return pickle.load(path.open('rb'))
+    def from_changes(old_tree, changes, api, root_folder=None, folders_per_query=50):
+        """ Build the new tree by applying the changes reported by the Drive Changes API to the old one (a FileTree or
+        a TreeStore snapshot) """
+        files = {data['id']: data for data in old_tree.to_json()}
+        removed = set()
+        new_folders = []
+
+        for gid, data in FileTree.__changed_files(changes, api).items():
+            if data is None:
+                files.pop(gid, None)
+                removed.add(gid)
+            else:
+                if data['mimeType'] == GMimeTypes.GFOLDER.value and gid not in files:
+                    new_folders.append(gid)
+                files[gid] = data
+
+        # Contents of removed folders are dropped as well
+        children = defaultdict(list)
+        for gid, data in files.items():
+            children[data.get('parents', [None])[0]].append(gid)
+        pending = list(removed)
+        while pending:
+            for gid in children.pop(pending.pop(), []):
+                if files.pop(gid, None):
+                    pending.append(gid)
+
+        # Folders that were moved into the tree bring contents which are not reported as changes
+        if new_folders:
+            for page in api.retrieve_descendants(new_folders, folders_per_query=folders_per_query):
+                for data in page:
+                    files[data['id']] = data
+
+        return FileTree(list(files.values()), root_folder)
+
+    def apply_changes(self, changes, api, root_folder=None, folders_per_query=50):
+        """ Applies the changes reported by the Drive Changes API to the tree in place, at a cost which mostly depends
+        on the changes, as the node lists are only walked to drop removed nodes. Returns a TreeSnapshot of the affected
+        nodes as they were, the affected nodes as they are now (with the contents of moved folders) and the gids of the
+        removed nodes """
+        size = len(self)
+        files = FileTree.__changed_files(changes, api)
+        before = {}
+        for gid in files:
+            if gid in self.index:
+                for node in FileTree.__subtree(self.index[gid]):
+                    if node.gid not in before:
+                        before[node.gid] = node.snapshot()
+
+        # Nodes are updated or created first and linked once all of them exist, as in __build
+        removed = {}
+        added = []
+        touched = []
+        upserts = [data for data in files.values() if data]
+        new_folders = [data['id'] for data in upserts
+                       if data['mimeType'] == GMimeTypes.GFOLDER.value and data['id'] not in self.index]
+        if new_folders:
+            # Folders that were moved into the tree bring contents which are not reported as changes
+            for page in api.retrieve_descendants(new_folders, folders_per_query=folders_per_query):
+                upserts.extend(page)
+        # Changed nodes are detached before the ones whose mime type changed are replaced with their contents, so the
+        # nodes moved out of a replaced folder are kept
+        for data in upserts:
+            node = self.index.get(data['id'], None)
+            if node and node.parent:
+                node.parent.children.remove(node)
+                node.parent = None
+        for data in upserts:
+            node = self.index.get(data['id'], None)
+            if node and node.mime_type != data['mimeType']:
+                self.__remove(node, removed)
+        for data in upserts:
+            node = self.index.get(data['id'], None)
+            if node:
+                node.update(data)
+            else:
+                node = Node.from_json(data)
+                node.parent = None
+                self.index[node.gid] = node
+                added.append(node)
+            touched.append((node, data.get('parents', [None])[0]))
+        for node, parent_gid in touched:
+            parent = self.index.get(parent_gid, None) if parent_gid else None
+            if node.parent is not parent:
+                if node.parent:
+                    node.parent.children.remove(node)
+                node.parent = parent
+                if parent:
+                    parent.children.append(node)
+            if not parent_gid and node not in self.roots:
+                self.roots.append(node)
+            elif parent_gid and node in self.roots:
+                self.roots.remove(node)
+
+        # Removed folders take their contents, and with root_folder so do folders moved out of it
+        for gid, data in files.items():
+            if data is None and gid in self.index:
+                self.__remove(self.index[gid], removed)
+        if root_folder:
+            in_root = {}
+            for node, _ in touched:
+                if node.gid in self.index and not FileTree.__is_in_root(node, root_folder, in_root):
+                    self.__remove(node, removed)
+
+        self.all_nodes.extend(added)
+        self.all_files.extend(node for node in added if node.is_file())
+        self.all_folders.extend(node for node in added if node.is_google_folder())
+        # Removed nodes are kept by id, as a node whose mime type changed is replaced by one with the same gid. Each
+        # list is only walked if it holds removed nodes
+        if removed:
+            self.all_nodes = [node for node in self.all_nodes if id(node) not in removed]
+            self.roots = [node for node in self.roots if id(node) not in removed]
+        if any(node.is_file() for node in removed.values()):
+            self.all_files = [node for node in self.all_files if id(node) not in removed]
+        if any(node.is_google_folder() for node in removed.values()):
+            self.all_folders = [node for node in self.all_folders if id(node) not in removed]
+
+        changed = {}
+        for gid in list(before) + [node.gid for node, _ in touched]:
+            if gid in self.index and gid not in changed:
+                for node in FileTree.__subtree(self.index[gid]):
+                    changed[node.gid] = node
+        return TreeSnapshot(before.values(), size), list(changed.values()), [g for g in before if g not in self.index]
 
     @staticmethod
-    def diff(old_files, new_files):
+    def diff(old_tree, new_tree, new_files=None):
+        """ Files to download, files to revise and (old, new) pairs of files and folders to move. Folders are only
+        paired when they were moved or renamed themselves, but every file whose path changed is paired. new_files are
+        the files of new_tree which may not be in old_tree, all of them by default """
         to_download = []
         to_move     = []
         to_revision = []
-
-        for old_file in old_files:
-            # Find matching file in new_files list
-            new_file = next((f for f in new_files if f == old_file), None)
+        old_gids    = set()
+
+        # Folders whose path changed, because they or one of their ancestors were moved or renamed
+        moved_dirs = set()
+        for old_folder in old_tree.all_folders:
+            new_folder = old_folder.find_in(new_tree.index)
+            if new_folder and old_folder.make_relative_path() != new_folder.make_relative_path():
+                moved_dirs.add(old_folder.gid)
+                if old_folder.was_moved_in(new_folder):
+                    to_move.append((old_folder, new_folder))
+
+        for old_file in old_tree.all_files:
+            old_gids.add(old_file.gid)
+            # Find matching file in the new tree
+            new_file = old_file.find_in(new_tree.index)
             # Check if file was deleted, modified or moved
             was_del = new_file is None
             was_mod = old_file.was_modified_in(new_file) if new_file else False
-            was_mov = old_file.was_moved_in(new_file) if new_file else False
+            was_mov = (old_file.was_moved_in(new_file) or old_file.parent_gid in moved_dirs) if new_file else False
 
             if was_del:
                 to_revision.append(old_file)
@@ -113,43 +356,144 @@ class FileTree:
                 to_revision.append(old_file)
             elif was_mov:
                 to_move.append((old_file, new_file))
+            if new_file and not was_mod and new_file.head_revision is None:
+                # Google files are listed without revision, so the one of their last export is kept
+                new_file.head_revision = old_file.head_revision
+            if new_file and not was_mod and not was_mov:
+                new_file.last_local_update = old_file.last_local_update
 
         # Add files that are new
-        to_download.extend([f for f in new_files if f not in old_files])
+        new_files = new_tree.all_files if new_files is None else new_files
+        to_download.extend([f for f in new_files if f.gid not in old_gids])
         return to_download, to_revision, to_move
 
     @staticmethod
-    def download_files(api, base_dir, files):
+    def skip_unchanged_exports(api, to_download, to_revision, to_move):
+        """ Looks up the head revision of the Google files to export. Modified files whose revision is the one already
+        exported are only moved if needed, since their exports would not change """
+        gids = [f.gid for f in to_download if f.is_google_file()]
+        if not gids:
+            return
+        revisions = api.get_head_revisions(gids)
+        old_files = {f.gid: f for f in to_revision}
+        skipped = set()
+        for new_file in to_download:
+            if new_file.gid not in revisions:
+                continue
+            new_file.head_revision = revisions[new_file.gid]
+            old_file = old_files.get(new_file.gid, None)
+            if old_file and old_file.head_revision and old_file.head_revision == new_file.head_revision:
+                skipped.add(new_file.gid)
+                new_file.last_local_update = old_file.last_local_update
+                if old_file.make_relative_path() != new_file.make_relative_path():
+                    to_move.append((old_file, new_file))
+        to_download[:] = [f for f in to_download if f.gid not in skipped]
+        to_revision[:] = [f for f in to_revision if f.gid not in skipped]
+        print('- Exports skipped (revision not changed): %d' % len(skipped))
+        metrics.count('exports_skipped', len(skipped))
+
+    @staticmethod
+    def find_duplicates(base_dir, new_tree, files, revision_store=None):
+        """ Splits files to download by their md5 into files to download, (file, source path) pairs of content which is
+        already in the backup or the revisions store, and (file, node) pairs of content downloaded for another node """
+        downloading = {f.gid for f in files}
+        needed = {f.md5 for f in files if f.md5}
+        sources = {}
+        if needed:
+            for f in new_tree.all_files:
+                if f.md5 in needed and f.gid not in downloading:
+                    sources.setdefault(f.md5, f.make_relative_path(base_dir))
+
+        to_download = []
+        to_copy = []
+        to_copy_after = []
+        first = {}
+        for f in files:
+            if not f.md5:
+                to_download.append(f)
+            elif f.md5 in sources:
+                to_copy.append((f, sources[f.md5]))
+            elif revision_store and revision_store.has_blob(f.md5):
+                to_copy.append((f, revision_store.blob_path(f.md5)))
+            elif f.md5 in first:
+                to_copy_after.append((f, first[f.md5]))
+            else:
+                first[f.md5] = f
+                to_download.append(f)
+        return to_download, to_copy, to_copy_after
+
+    @staticmethod
+    def copy_files(base_dir, pairs):
+        """ Copies (file, source) pairs, where source is a path or a node in the backup. Returns the files that could
+        not be copied and the bytes copied """
         fails = []
-        generator = file_op_decorator(files,
-                                      '* Downloading new files. Updates may be slow for large files',
-                                      '* Download new files, DONE')
-        for file in generator:
+        copied = 0
+        generator = file_op_decorator(pairs, '* Copying duplicated files', '* Copying duplicated files, DONE')
+        for file, source in generator:
+            if not isinstance(source, Path):
+                source = source.make_relative_path(base_dir)
             path = file.make_relative_path(base_dir)
             try:
                 path.parents[0].mkdir(exist_ok=True, parents=True)
-                if file.is_google_file():
-                    api.export_file(file.gid, path)
-                else:
-                    api.get_file(file.gid, path)
-            except errors.HttpError as e:
-                if e.resp.status != 403:  # File too big to export
-                    fails.append('%s [HTTP Error %s. %s]' % (path, e.resp.status, e._get_reason()))
-                else:
-                    FileTree.__try_using_export_from_link(fails, file, api, path)
+                with source.open('rb') as src, atomic_write(path) as dst:
+                    shutil.copyfileobj(src, dst)
+                file.update_local_modified_time(base_dir)
+                copied += file.size or 0
             except Exception as e:
-                if not file.is_google_file():
-                    fails.append('%s [%s]' % (path, str(e)))
-                else:
-                    FileTree.__try_using_export_from_link(fails, file, api, path)
+                print('- Error: %s => %s [%s]' % (source, path, str(e)))
+                fails.append(file)
+        return fails, copied
+
+    @staticmethod
+    def download_files(api, base_dir, files, scheduler=None):
+        """ Downloads files in the order of the scheduler. Returns the files deferred by its budgets """
+        if scheduler is None:
+            scheduler = DownloadScheduler()
+
+        def job(file, progress):
+            return FileTree.__download_file(api, base_dir, file, progress)
 
+        fails, deferred = scheduler.run(files, job, '* Downloading new files', '* Download new files, DONE')
         for path in fails:
             print('- Error: %s' % path)
+        return deferred
+
+    @staticmethod
+    def __download_file(api, base_dir, file, progress=None):
+        fails = []
+        path = file.make_relative_path(base_dir)
+        try:
+            path.parents[0].mkdir(exist_ok=True, parents=True)
+            if file.is_google_file():
+                FileTree.__export_file(api, base_dir, file, progress, fails)
+            else:
+                api.get_file(file.gid, path, file.modified_time, file.size, progress)
+                file.update_local_modified_time(base_dir)
+        except errors.HttpError as e:
+            fails.append('%s [HTTP Error %s. %s]' % (path, e.resp.status, e._get_reason()))
+        except Exception as e:
+            fails.append('%s [%s]' % (path, str(e)))
+        return fails
+
+    @staticmethod
+    def __export_file(api, base_dir, file, progress, fails):
+        # All the formats are exported at once. Exports that fail (i.e. too big) are retried through export links
+        targets = file.export_paths(base_dir)
+        results = api.export_files(file.gid, [(EXPORT_MIME_TYPES[f], path) for f, path in targets], progress)
+        for (export_format, path), e in zip(targets, results):
+            if isinstance(e, errors.HttpError) and e.resp.status != 403:  # 403: File too big to export
+                fails.append('%s [HTTP Error %s. %s]' % (path, e.resp.status, e._get_reason()))
+            elif e:
+                FileTree.__try_using_export_from_link(fails, file, api, base_dir, export_format, path, progress)
+        if not results[0]:
+            file.update_local_modified_time(base_dir)
 
     @staticmethod
-    def __try_using_export_from_link(fails, file, api, path):
+    def __try_using_export_from_link(fails, file, api, base_dir, export_format, path, progress=None):
         try:
-            api.download_export_from_link(file.export_links['application/pdf'], path)
+            api.download_export_from_link(file.export_links[EXPORT_MIME_TYPES[export_format]], path, progress)
+            if path == file.make_relative_path(base_dir):
+                file.update_local_modified_time(base_dir)
         except Exception as e:
             print('%s [%s]' % (path, str(e)))
             fails.append('%s [%s]' % (path, str(e)))
@@ -157,74 +501,212 @@ class FileTree:
     @staticmethod
     def revise_files(base_dir, revision_dir, files):
         fails = []
+        created_dirs = set()
+        left_dirs = set()
         generator = file_op_decorator(files, '* Moving deleted files', '* Moving deleted files, DONE')
 
         for file in generator:
             try:
-                FileTree.move_file(origin=file.make_relative_path(base_dir),
-                                   destination=revision_dir / Path(file.gid[:5] + '_' + file.name),
-                                   remove_parents_until=base_dir)
+                for export_format, path in file.export_paths(base_dir)[1:]:
+                    if path.exists():
+                        FileTree.move_file(origin=path,
+                                           destination=revision_dir / ('%s_%s.%s' % (file.gid[:5], file.name,
+                                                                                     export_format)),
+                                           created_dirs=created_dirs)
+                origin = file.make_relative_path(base_dir)
+                FileTree.move_file(origin=origin, destination=revision_dir / Path(file.gid[:5] + '_' + file.name),
+                                   created_dirs=created_dirs)
+                left_dirs.add(origin.parents[0])
             except Exception as e:
                 fails.append(e)
+        remove_empty_dirs(left_dirs, base_dir)
         for path in fails:
             print('- Error: %s' % path)
 
     @staticmethod
-    def move_files(base_dir, files):
+    def move_files(base_dir, pairs):
+        """ Applies the (old, new) pairs of FileTree.diff. Moved folders are renamed as a whole, and only the files
+        which are not in place after those renames are moved one by one """
         fails = []
+        renamed, left_dirs = FileTree.__rename_folders(base_dir, [p for p in pairs if p[1].is_google_folder()], fails)
+        created_dirs = set()
+        files = [p for p in pairs if p[1].is_file()]
         generator = file_op_decorator(files, '* Moving moved files', '* Moving moved files, DONE')
 
-        for pair in generator:
+        for old_file, new_file in generator:
             try:
-                FileTree.move_file(origin=pair[0].make_relative_path(base_dir),
-                                   destination=pair[1].make_relative_path(base_dir),
-                                   remove_parents_until=base_dir)
+                origin = base_dir / FileTree.__renamed_path(old_file.make_relative_path(), renamed)
+                if origin != new_file.make_relative_path(base_dir):
+                    # Other export formats of Google files are moved along
+                    destinations = dict(new_file.export_paths(base_dir))
+                    for export_format, path in old_file.export_paths()[1:]:
+                        path = base_dir / FileTree.__renamed_path(path, renamed)
+                        if path.exists() and export_format in destinations:
+                            FileTree.move_file(origin=path, destination=destinations[export_format],
+                                               created_dirs=created_dirs)
+                    FileTree.move_file(origin=origin, destination=new_file.make_relative_path(base_dir),
+                                       created_dirs=created_dirs)
+                    left_dirs.add(origin.parents[0])
+                # Moving keeps the modification time
+                new_file.last_local_update = old_file.last_local_update
             except Exception as e:
                 fails.append(e)
+        remove_empty_dirs(left_dirs, base_dir)
         for path in fails:
             print('- Error: %s' % path)
 
     @staticmethod
-    def move_file(origin: Path, destination: Path, remove_parents_until=None):
+    def move_file(origin: Path, destination: Path, created_dirs: set):
+        """ Moves origin to destination. Its folder is only created if it is not in created_dirs """
         if not origin.exists():
             raise Exception('%s [File was not found in the backup]' % origin)
         try:
-            destination.parents[0].mkdir(exist_ok=True, parents=True)
+            folder = destination.parents[0]
+            if folder not in created_dirs:
+                folder.mkdir(exist_ok=True, parents=True)
+                created_dirs.add(folder)
             shutil.move(str(origin), str(destination))
-            if remove_parents_until:
-                recursive_rmdir_parents(origin.parents[0], remove_parents_until)
         except Exception as e:
             raise Exception('%s => %s [%s]' % (origin, destination, str(e)))
 
     # Private ----------------------------------------------------------------------------------------------------------
 
-    def __build(self, files, root_folder):
-        self.__fill_nodes_and_roots(files)
-        self.__build_tree()
+    @staticmethod
+    def __rename_folders(base_dir, pairs, fails):
+        """ Renames the folders of the (old, new) pairs, shallowest destination first, so the new parent of a folder is
+        renamed into place before the folder is moved into it. Paths are mapped through the renames already done.
+        Folders whose destination already exists are left for their files to be moved one by one.
+        Returns the {old: new} relative paths of the renamed folders and the folders they were moved out of """
+        renamed = {}
+        left_dirs = set()
+        for old_folder, new_folder in sorted(pairs, key=lambda p: len(p[1].make_relative_path().parts)):
+            old_path = old_folder.make_relative_path()
+            origin = base_dir / FileTree.__renamed_path(old_path, renamed)
+            destination = new_folder.make_relative_path(base_dir)
+            if not origin.is_dir() or destination.exists():
+                continue
+            try:
+                destination.parents[0].mkdir(exist_ok=True, parents=True)
+                origin.rename(destination)
+                renamed[old_path] = new_folder.make_relative_path()
+                left_dirs.add(origin.parents[0])
+            except Exception as e:
+                fails.append('%s => %s [%s]' % (origin, destination, str(e)))
+        if pairs:
+            print('- Folders renamed: %d of %d' % (len(renamed), len(pairs)))
+        metrics.count('folders_renamed', len(renamed))
+        return renamed, left_dirs
+
+    @staticmethod
+    def __changed_files(changes, api):
+        # Data of each changed file by gid, or None if it was removed. Changes reported without file metadata are
+        # requested in batches
+        missing = [change['fileId'] for change in changes if not change.get('removed', False) and 'file' not in change]
+        metadata = dict(zip(missing, api.get_files_metadata(missing))) if missing else {}
+
+        files = {}
+        for change in changes:
+            gid = change['fileId']
+            data = change.get('file', metadata.get(gid, None))
+            if isinstance(data, errors.HttpError) and data.resp.status == 404:
+                data = None  # Not accessible anymore
+            elif isinstance(data, Exception):
+                print('- Error: Could not retrieve metadata of changed file %s [%s]' % (gid, str(data)))
+                continue
+            if change.get('removed', False) or not data or data['trashed']:
+                data = None
+            files[gid] = data
+        return files
+
+    @staticmethod
+    def __subtree(node):
+        nodes = [node]
+        pending = [node]
+        while pending:
+            children = pending.pop().children
+            nodes.extend(children)
+            pending.extend(c for c in children if c.is_google_folder())
+        return nodes
+
+    def __remove(self, node, removed):
+        # Unlinks node and its contents from the tree. The node lists are filtered by the caller
+        if node.parent:
+            node.parent.children.remove(node)
+            node.parent = None
+        for n in FileTree.__subtree(node):
+            self.index.pop(n.gid, None)
+            removed[id(n)] = n
+
+    @staticmethod
+    def __stat(path: Path):
+        # (size, modification time) of path as in scan_dir, or None if it does not exist
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        return st.st_size, st.st_mtime
+
+    @staticmethod
+    def __renamed_path(path: Path, renamed):
+        # Location of path after the renames of its deepest renamed ancestor
+        if renamed:
+            for parent in path.parents:
+                if parent in renamed:
+                    return renamed[parent] / path.relative_to(parent)
+        return path
+
+    def __build(self, pages, root_folder):
+        folders = {}
+        waiting = defaultdict(list)  # Nodes listed before their parent folder, by parent gid
+        listed = 0
+        for page in pages:
+            listed += len(page)
+            self.__add_page(page, folders, waiting)
         self.__remove_orphan(root_folder)
         self.all_files   = [f for f in self.all_nodes if f.is_file()]
         self.all_folders = [f for f in self.all_nodes if f.is_google_folder()]
-        print('(%d orphan/trashed files or dirs ignored)' % (len(files) - len(self.all_nodes)))
-
-    def __fill_nodes_and_roots(self, files, ignore_trashed=True):
-        # Convert files and folders data (json) into nodes
-        self.all_nodes = []
-        self.roots = []
-        for f in files:
-            if not ignore_trashed or not f['trashed']:
-                node = Node.from_json(f)
-                self.all_nodes.append(node)
-                if not node.parent:
-                    self.roots.append(node)
-
-    def __build_tree(self):
-        # Build the actual tree using node.parent property which contains the immediate parent id
-        for file in self.all_nodes:
-            file.parent = next((folder for folder in self.all_nodes if file.parent == folder.gid), None)
-            if file.parent:
-                file.parent.children.append(file)
+        self.index       = {f.gid: f for f in self.all_nodes}
+        print('(%d orphan/trashed files or dirs ignored)' % (listed - len(self.all_nodes)))
+
+    def __add_page(self, page, folders, waiting, ignore_trashed=True):
+        # Convert files and folders data (json) into nodes and link them to their parent folder, which contains the
+        # immediate parent id until then. Nodes whose parent is not listed yet wait for it
+        for f in page:
+            if ignore_trashed and f['trashed']:
+                continue
+            node = Node.from_json(f)
+            self.all_nodes.append(node)
+            if node.is_google_folder():
+                folders[node.gid] = node
+                for child in waiting.pop(node.gid, ()):
+                    child.parent = node
+                    node.children.append(child)
+            parent_gid = node.parent
+            node.parent = folders.get(parent_gid, None)
+            if node.parent:
+                node.parent.children.append(node)
+            elif parent_gid:
+                waiting[parent_gid].append(node)
+            else:
+                self.roots.append(node)
 
     def __remove_orphan(self, root_folder):
         # Find nodes that do not belong to the desired root folder if specified
         if root_folder:
-            self.all_nodes = [f for f in self.all_nodes if f.get_top_node().name == root_folder]
+            in_root = {}  # Memoized root membership by folder gid
+            self.all_nodes = [f for f in self.all_nodes if FileTree.__is_in_root(f, root_folder, in_root)]
+
+    @staticmethod
+    def __is_in_root(node, root_folder, in_root):
+        # Walk up until a folder with known membership (or the top node) is found, then memoize the whole chain
+        chain = []
+        current = node
+        while current.gid not in in_root and current.parent:
+            chain.append(current)
+            current = current.parent
+        result = in_root.get(current.gid, current.name == root_folder)
+        in_root[current.gid] = result
+        for f in chain:
+            if f.is_google_folder():
+                in_root[f.gid] = result
+        return result
@@ -1,74 +1,262 @@
+import calendar
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import List
+from typing import Dict
 
-from GDriveAPI import GMimeTypes
+from GDriveAPI import GMimeTypes, EXPORT_LINKS, EXPORT_MIME_TYPES
 
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
-class FileTreeNode(object):
+# Mime types are stored in nodes as small ids into this table. Google types get the lowest ids
+MIME_TYPES = [m.value for m in GMimeTypes]
+MIME_IDS = {m: i for i, m in enumerate(MIME_TYPES)}
+GFOLDER_ID = MIME_IDS[GMimeTypes.GFOLDER.value]
 
-    def __init__(self, gid, name, mime_type, created_time, modified_time,
-                 parent=None, export_links=None, last_local_update=None):
-        if export_links is None:
-            export_links = []
+
+def mime_id(mime_type):
+    i = MIME_IDS.get(mime_type, None)
+    if i is None:
+        i = MIME_IDS.setdefault(mime_type, len(MIME_TYPES))
+        if i == len(MIME_TYPES):
+            MIME_TYPES.append(mime_type)
+    return i
+
+
+# Formats (extensions) Google files are exported to, by mime type. The first one is the file of the backup tree and the
+# others are saved next to it. Google files not listed are exported to pdf
+EXPORT_FORMATS = {}
+
+
+def set_export_formats(formats):
+    """ Sets EXPORT_FORMATS from a map of GMimeTypes names (i.e. GDOCS) to lists of extensions """
+    EXPORT_FORMATS.clear()
+    for name, extensions in formats.items():
+        if name not in GMimeTypes.__members__ or not extensions:
+            raise ValueError('Invalid export formats for %s' % name)
+        unknown = [e for e in extensions if e not in EXPORT_MIME_TYPES]
+        if unknown:
+            raise ValueError('Unknown export formats %s for %s' % (', '.join(unknown), name))
+        EXPORT_FORMATS[GMimeTypes[name].value] = list(extensions)
+
+
+def export_formats(mime_type):
+    return EXPORT_FORMATS.get(mime_type, ['pdf'])
+
+
+def parse_time(value):
+    """ Milliseconds since epoch of a Drive RFC 3339 time (i.e. 2020-01-31T10:00:00.000Z) """
+    if not isinstance(value, str):
+        return value
+    seconds = calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                               int(value[11:13]), int(value[14:16]), int(value[17:19])))
+    return seconds * 1000 + (int(value[20:23]) if len(value) > 20 else 0)
+
+
+def format_time(value):
+    """ Inverse of parse_time """
+    t = EPOCH + timedelta(milliseconds=value)
+    return t.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (value % 1000)
+
+
+class DriveNode(object):
+    """ Comparisons and serialization shared by FileTreeNode and the rows of a TreeStore. Subclasses provide gid,
+    parent_gid, name, mime_type, created_time, modified_time, size, md5, head_revision and make_relative_path """
+    __slots__ = ()
+
+    def is_google_file(self):
+        return GMimeTypes.GPREFIX.value in self.mime_type and self.mime_type != GMimeTypes.GFOLDER.value
+
+    def find_in(self, index: Dict[str, '__class__']):
+        return index.get(self.gid, None)
+
+    def export_paths(self, base_dir=None):
+        """ (format, path) of each export of a Google file, the first one being make_relative_path """
+        if not self.is_google_file():
+            return []
+        path = self.make_relative_path(base_dir)
+        return [(f, path.with_suffix('.' + f)) for f in export_formats(self.mime_type)]
+
+    def was_modified_in(self, new):
+        # Content changes. Checksums are used when available so metadata only updates are not downloaded again
+        assert self.gid == new.gid
+        if self.md5 and new.md5:
+            return self.md5 != new.md5
+        return self.modified_time != new.modified_time
+
+    def was_moved_in(self, new):
+        # Moved to another folder or renamed
+        assert self.gid == new.gid
+        return self.parent_gid != new.parent_gid or self.name != new.name
+
+    def to_json(self):
+        # Inverse of FileTreeNode.from_json, as returned by the Drive API
+        data = {'id': self.gid, 'name': self.name, 'mimeType': self.mime_type, 'trashed': False,
+                'createdTime': format_time(self.created_time), 'modifiedTime': format_time(self.modified_time)}
+        if self.parent_gid:
+            data['parents'] = [self.parent_gid]
+        if self.size is not None:
+            data['size'] = str(self.size)
+        if self.md5:
+            data['md5Checksum'] = self.md5
+        if self.head_revision:
+            data['headRevisionId'] = self.head_revision
+        return data
+
+    def __str__(self):
+        return self.name
+
+
+class StoredFile(DriveNode):
+    """ Read only copy of a node with its relative path, as a row of a TreeStore or as a node before changes applied to
+    a FileTree in place. Has the FileTreeNode methods used to diff and check backups """
+
+    def __init__(self, gid, parent, name, mime_type, created_time, modified_time, size, last_local_update, path,
+                 md5, head_revision):
         self.gid = gid
+        self.parent = parent
         self.name = name
         self.mime_type = mime_type
         self.created_time = created_time
         self.modified_time = modified_time
+        self.size = size
         self.last_local_update = last_local_update
-        self.export_links = export_links
-        self.parent = parent
-        self.children = []
+        self.path = Path(path)
+        self.md5 = md5
+        self.head_revision = head_revision
+
+    @property
+    def parent_gid(self):
+        return self.parent
+
+    def make_relative_path(self, base_dir=None):
+        return base_dir / self.path if base_dir else self.path
+
+
+class FileTreeNode(DriveNode):
+    __slots__ = ('gid', '_name', 'mime', 'created_time', 'modified_time', 'last_local_update', 'size', 'md5',
+                 'head_revision', '_parent', 'children', '_path')
+
+    def __init__(self, gid, name, mime_type, created_time, modified_time,
+                 parent=None, last_local_update=None, size=None, md5=None, head_revision=None):
+        self.gid = gid
+        self._name = name
+        self.mime = mime_id(mime_type)
+        self.created_time = parse_time(created_time)
+        self.modified_time = parse_time(modified_time)
+        self.last_local_update = last_local_update
+        self.size = size
+        self.md5 = md5  # Only binary files have checksum and revisions
+        self.head_revision = head_revision
+        self._parent = parent
+        self.children = [] if self.mime == GFOLDER_ID else ()
+        self._path = None  # Relative path of folders, computed once
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        self._name = value
+        self.invalidate_path()
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @parent.setter
+    def parent(self, value):
+        self._parent = value
+        self.invalidate_path()
+
+    @property
+    def parent_gid(self):
+        return self._parent.gid if self._parent else None
+
+    @property
+    def mime_type(self):
+        return MIME_TYPES[self.mime]
+
+    @property
+    def export_links(self):
+        # Derived from the gid instead of being stored for each node
+        template = EXPORT_LINKS.get(self.mime_type, None)
+        if not template:
+            return {}
+        return {EXPORT_MIME_TYPES[f]: template % (self.gid, f) for f in export_formats(self.mime_type)}
 
     def is_file(self):
         return not self.is_google_folder()
 
-    def is_google_file(self):
-        return GMimeTypes.GPREFIX.value in self.mime_type and not self.is_google_folder()
-
     def is_google_folder(self):
-        return self.mime_type == GMimeTypes.GFOLDER.value
+        return self.mime == GFOLDER_ID
 
-    def find_in_list(self, l: List['__class__']):
-        for i, item in enumerate(l):
-            if self == item:
-                return i
-        return None
+    def update(self, data):
+        """ Takes the metadata of data (json) except its parent, which is linked by the tree. The local modification
+        time is reset, as for a node built from data """
+        if data['name'] != self._name:
+            self.name = data['name']
+        self.created_time = parse_time(data['createdTime'])
+        self.modified_time = parse_time(data['modifiedTime'])
+        self.size = int(data['size']) if 'size' in data else None
+        self.md5 = data.get('md5Checksum', None)
+        self.head_revision = data.get('headRevisionId', None)
+        self.last_local_update = None
 
-    def get_top_node(self):
-        if not self.parent:
-            return self
-        return self.parent.get_top_node()
+    def snapshot(self):
+        """ Read only copy of the node and its current path """
+        return StoredFile(self.gid, self.parent_gid, self._name, self.mime_type, self.created_time, self.modified_time,
+                          self.size, self.last_local_update, self.make_relative_path(), self.md5, self.head_revision)
 
     def update_local_modified_time(self, base_dir=Path('.')):
         path = base_dir / self.make_relative_path()
         self.last_local_update = path.stat().st_mtime
 
+    def folder_path(self):
+        """ Relative path of a folder, cached until it or any of its ancestors is renamed or moved """
+        if self._path is None:
+            self._path = self._parent.folder_path() / self._name if self._parent else Path(self._name)
+        return self._path
+
+    def invalidate_path(self):
+        # Folder paths are only cached below cached folders, so the walk stops at folders without cache
+        self._path = None
+        pending = [c for c in self.children if c.mime == GFOLDER_ID]
+        while pending:
+            folder = pending.pop()
+            if folder._path is not None:
+                folder._path = None
+                pending.extend(c for c in folder.children if c.mime == GFOLDER_ID)
+
     def make_relative_path(self, base_dir=None, google_file_suffix_pdf=True):
-        path = Path('')
-        current = self.parent
-        while current:
-            path = Path(current.name) / path
-            current = current.parent
-        path = path / self.name
+        # Google files get the suffix of their first export format, pdf by default
+        path = self._parent.folder_path() / self._name if self._parent else Path(self._name)
         if self.is_google_file() and google_file_suffix_pdf:
-            path = path.with_suffix('.pdf')
+            path = path.with_suffix('.' + export_formats(self.mime_type)[0])
         if base_dir:
             path = base_dir / path
         return path
 
-    def was_modified_in(self, new):
-        assert isinstance(new, FileTreeNode)
-        assert self.gid == new.gid
-        return self.modified_time != new.modified_time or self.name != new.name
+    def __getstate__(self):
+        # Mime ids are only valid in the current process, so the mime type is pickled instead
+        return {'gid': self.gid, 'name': self._name, 'mime_type': self.mime_type, 'created_time': self.created_time,
+                'modified_time': self.modified_time, 'last_local_update': self.last_local_update, 'size': self.size,
+                'md5': self.md5, 'head_revision': self.head_revision, 'parent': self._parent, 'children': self.children}
 
-    def was_moved_in(self, new):
-        assert isinstance(new, FileTreeNode)
-        assert self.gid == new.gid
-        return self.parent != new.parent
-
-    def __str__(self):
-        return self.name
+    def __setstate__(self, state):
+        # Also accepts the __dict__ of nodes pickled by versions without slots
+        self.gid = state['gid']
+        self._name = state['name']
+        self.mime = mime_id(state['mime_type'])
+        self.created_time = parse_time(state['created_time'])
+        self.modified_time = parse_time(state['modified_time'])
+        self.last_local_update = state.get('last_local_update', None)
+        self.size = state.get('size', None)
+        self.md5 = state.get('md5', None)
+        self.head_revision = state.get('head_revision', None)
+        self._parent = state['parent']
+        self.children = state['children']
+        self._path = None
 
     def __eq__(self, other):
         assert isinstance(other, FileTreeNode)
@@ -78,4 +266,5 @@ class FileTreeNode(object):
     def from_json(data):
         # Only first parent is used
         return FileTreeNode(data['id'], data['name'], data['mimeType'], data['createdTime'], data['modifiedTime'],
-                            data.get('parents', [None])[0], data.get('exportLinks', None))
+                            data.get('parents', [None])[0], size=int(data['size']) if 'size' in data else None,
+                            md5=data.get('md5Checksum', None), head_revision=data.get('headRevisionId', None))
@@ -1,6 +1,17 @@
-import io
+import json
+import os
 import pickle
+import queue
+import re
+import random
+import shutil
+import socket
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
 from enum import Enum
 from pathlib import Path
 
@@ -9,7 +20,9 @@ from apiclient import errors
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.http import BatchHttpRequest, MediaIoBaseDownload
+
+from Metrics import metrics
 
 
 class GMimeTypes(Enum):
@@ -27,108 +40,574 @@ class GMimeTypes(Enum):
     GSPREADSHEET  = 'application/vnd.google-apps.spreadsheet'
 
 
+FILE_FIELDS = 'id, name, mimeType, trashed, createdTime, modifiedTime, parents, size, md5Checksum, headRevisionId'
+
+# Families of binary files listed by their own query when there is no root folder to partition the listing by
+SPLIT_MIME_TYPES = ('image/', 'video/', 'audio/', 'text/', 'application/pdf', 'application/zip')
+
+# Mime types of the formats Google files can be exported to, by extension
+EXPORT_MIME_TYPES = {
+    'pdf': 'application/pdf',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    'odt': 'application/vnd.oasis.opendocument.text',
+    'ods': 'application/x-vnd.oasis.opendocument.spreadsheet',
+    'odp': 'application/vnd.oasis.opendocument.presentation',
+    'rtf': 'application/rtf',
+    'epub': 'application/epub+zip',
+    'txt': 'text/plain',
+    'csv': 'text/csv',
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'svg': 'image/svg+xml',
+}
+
+# Export urls of Google files by mime type, formatted with the file id and the export format (i.e. pdf)
+EXPORT_LINKS = {
+    GMimeTypes.GDOCS.value: 'https://docs.google.com/feeds/download/documents/export/Export?id=%s&exportFormat=%s',
+    GMimeTypes.GDRAWING.value: 'https://docs.google.com/feeds/download/drawings/Export?id=%s&exportFormat=%s',
+    GMimeTypes.GPRESENTATION.value: 'https://docs.google.com/feeds/download/presentations/Export?id=%s&exportFormat=%s',
+    GMimeTypes.GSPREADSHEET.value: 'https://docs.google.com/spreadsheets/export?id=%s&exportFormat=%s',
+}
+
+
+# Temporary files of atomic_write. Any found before writing starts was left by a run which was killed
+ATOMIC_WRITE_TMP = re.compile(r'^\..+\.[0-9a-f]{8}\.part$')
+
+
+@contextmanager
+def atomic_write(path: Path):
+    """ Opens a hidden temporary file next to path which replaces it only if the block finishes without errors """
+    tmp_path = path.with_name('.%s.%s.part' % (path.name, uuid.uuid4().hex[:8]))
+    try:
+        with tmp_path.open('xb') as f:
+            yield f
+        os.replace(str(tmp_path), str(path))
+    except BaseException:
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
+
+
+class PartialDownload:
+    """ Data of an unfinished download, kept between runs next to the remote metadata it was requested for """
+
+    def __init__(self, directory: Path, gid, modified_time, size):
+        self.data_path = directory / ('%s.part' % gid)
+        self.meta_path = directory / ('%s.json' % gid)
+        self.meta = {'gid': gid, 'modified_time': modified_time, 'size': size}
+
+    def resume_offset(self):
+        # Data can only be resumed if it was requested for the same remote version of the file
+        try:
+            with self.meta_path.open('r') as f:
+                meta = json.load(f)
+            offset = self.data_path.stat().st_size
+        except (FileNotFoundError, json.JSONDecodeError):
+            meta, offset = None, 0
+        if meta != self.meta or offset > self.meta['size']:
+            self.discard()
+            return 0
+        return offset
+
+    def start(self):
+        self.meta_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.meta_path.open('w') as f:
+            json.dump(self.meta, f)
+
+    def finish(self, out_path: Path):
+        try:
+            os.replace(str(self.data_path), str(out_path))
+        except OSError:
+            # Partial downloads directory is in another file system
+            with self.data_path.open('rb') as src, atomic_write(out_path) as dst:
+                shutil.copyfileobj(src, dst)
+        self.discard()
+
+    def discard(self):
+        for path in (self.data_path, self.meta_path):
+            if path.exists():
+                path.unlink()
+
+
+class TokenBucket:
+    """ Thread safe rate limiter allowing `rate` acquisitions per second with bursts of up to `capacity` """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = capacity
+        self.__last = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__last) * self.rate)
+            self.__last = now
+            # Reserve a token now, even if it has not been refilled yet, and wait for it outside the lock
+            self.__tokens -= 1
+            wait = -self.__tokens / self.rate
+        if wait > 0:
+            metrics.count('limiter_sleeps')
+            metrics.count('limiter_sleep_s', wait)
+            time.sleep(wait)
+
+
+class ExportLinkError(Exception):
+
+    def __init__(self, status, retry_after=None):
+        super().__init__('Could not download file using export url [HTTP Error %s]' % status)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class RetryPolicy:
+    """ Exponential backoff with jitter shared by every API call. Retries on 429, 5xx, rate limit 403 and network
+    errors, honouring Retry-After, until `retries` attempts or `deadline_s` seconds spent waiting between attempts.
+    Time spent in the attempts themselves (i.e. long downloads) does not count towards the deadline. Counts calls,
+    retries, throttles (429 and rate limit 403) and waited seconds by endpoint """
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+    RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+    NETWORK_ERRORS = (ConnectionError, TimeoutError, socket.timeout,
+                      requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+    def __init__(self, retries=10, initial_wait_s=1, multiplier=2, max_wait_s=60, deadline_s=600):
+        assert multiplier >= 1
+        self.retries = retries
+        self.initial_wait_s = initial_wait_s
+        self.multiplier = multiplier
+        self.max_wait_s = max_wait_s
+        self.deadline_s = deadline_s
+        self.__counters = {}
+        self.__lock = threading.Lock()
+
+    def call(self, endpoint, function):
+        """ Returns function() retrying it while its errors are transient """
+        attempt = 0
+        waited = 0
+        while True:
+            self.count(endpoint, 'calls')
+            try:
+                return function()
+            except Exception as e:
+                wait = self.backoff(endpoint, e, attempt, waited)
+                if wait is None:
+                    raise
+                time.sleep(wait)
+                attempt += 1
+                waited += wait
+
+    def backoff(self, endpoint, error, attempt, waited):
+        """ Seconds to wait before retrying after error, or None if it should not be retried. waited are the seconds
+        already waited for previous attempts """
+        status, retry_after, throttled = self.__classify(error)
+        if status is None or attempt >= self.retries:
+            return None
+        wait = min(self.initial_wait_s * self.multiplier ** attempt, self.max_wait_s)
+        wait = wait / 2 + random.uniform(0, wait / 2)
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+        if waited + wait > self.deadline_s:
+            return None
+        self.count(endpoint, 'retries')
+        if throttled:
+            self.count(endpoint, 'throttles')
+        self.count(endpoint, 'wait_s', wait)
+        return wait
+
+    def count(self, endpoint, counter, value=1):
+        with self.__lock:
+            counters = self.__counters.setdefault(endpoint, {'calls': 0, 'retries': 0, 'throttles': 0, 'wait_s': 0})
+            counters[counter] += value
+
+    def stats(self):
+        with self.__lock:
+            return {endpoint: dict(counters) for endpoint, counters in self.__counters.items()}
+
+    def reset_stats(self):
+        with self.__lock:
+            self.__counters = {}
+
+    def __classify(self, error):
+        # Returns (status, retry_after, throttled), status being None for errors that are not retried
+        if isinstance(error, self.NETWORK_ERRORS):
+            return 'network', None, False
+        if isinstance(error, errors.HttpError):
+            status = error.resp.status
+            retry_after = error.resp.get('retry-after', None)
+            rate_limited = status == 403 and bool(RetryPolicy.__reasons(error) & self.RATE_LIMIT_REASONS)
+            throttled = status == 429 or rate_limited
+        elif isinstance(error, ExportLinkError):
+            status, retry_after, throttled = error.status, error.retry_after, error.status == 429
+        else:
+            return None, None, False
+        if status not in self.RETRY_STATUS and not throttled:
+            return None, None, False
+        return status, RetryPolicy.__parse_retry_after(retry_after), throttled
+
+    @staticmethod
+    def __reasons(error):
+        # The reason codes (i.e. userRateLimitExceeded) are in the details that _get_reason parses, not in its result
+        error._get_reason()
+        details = getattr(error, 'error_details', None)
+        if not isinstance(details, list):
+            return set()
+        return {detail.get('reason', None) for detail in details if isinstance(detail, dict)}
+
+    @staticmethod
+    def __parse_retry_after(value):
+        # Either seconds or an HTTP date
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+
+
 class GDriveAPI:
 
-    def __init__(self, credentials_path: Path, token_pickle_path: Path, scopes, request_second=10):
+    def __init__(self, credentials_path: Path, token_pickle_path: Path, scopes, request_second=10,
+                 chunk_size=10 * 1024 * 1024, partial_dir: Path = None, retry_policy: RetryPolicy = None,
+                 root_url=None):
+        """ root_url replaces https://www.googleapis.com/ and the export links host (i.e. to run against FakeDrive) """
         self.__scopes = scopes
+        self.__root_url = root_url
+        self.retry_policy = retry_policy if retry_policy else RetryPolicy()
+        self.__chunk_size = chunk_size
+        self.__partial_dir = Path(partial_dir) if partial_dir else None
         self.__credentials = None
         self.__credentials_path = Path(credentials_path)
         self.__token_pickle_path = Path(token_pickle_path)
-        self.__time_request = 1.0 / request_second
-        self.__last_request = 0
-        self.service = self.__build_service()
+        self.__limiter = TokenBucket(request_second)
+        self.__local = threading.local()
+        self.__export_executor = None
+        self.__executor_lock = threading.Lock()
+        self.__load_credentials()
+
+    @property
+    def service(self):
+        # Service objects are not thread safe, so each thread builds and keeps its own
+        service = getattr(self.__local, 'service', None)
+        if service is None:
+            options = {'api_endpoint': self.__root_url + 'drive/v3/'} if self.__root_url else None
+            service = self.__local.service = build('drive', 'v3', credentials=self.__credentials,
+                                                   client_options=options)
+        return service
 
     def user_info(self):
-        return self.__execute_request(self.service.about().get(fields='user'))
+        return self.__execute_request(self.service.about().get(fields='user'), 'about.get')
 
-    def export_file(self, gid, out_path: Path, mime_type='application/pdf'):
+    def export_file(self, gid, out_path: Path, mime_type='application/pdf', progress=None):
         request = self.service.files().export_media(fileId=gid, mimeType=mime_type)
-        self.__execute_download(request, out_path)
+        self.__execute_download(request, 'files.export', out_path, progress=progress)
+
+    def export_files(self, gid, targets, progress=None):
+        """ Exports the file to each (mime type, out path) of targets at once. Returns the exception each export failed
+        with, or None """
+        with self.__executor_lock:
+            # Shared by all files so its threads keep their services
+            if self.__export_executor is None:
+                self.__export_executor = ThreadPoolExecutor(max_workers=4)
+        futures = [self.__export_executor.submit(self.export_file, gid, out_path, mime_type, progress)
+                   for mime_type, out_path in targets[1:]]
+        results = []
+        try:
+            self.export_file(gid, targets[0][1], targets[0][0], progress)
+            results.append(None)
+        except Exception as e:
+            results.append(e)
+        results.extend(future.exception() for future in futures)
+        return results
 
-    def get_file(self, gid, out_path: Path):
+    def get_file(self, gid, out_path: Path, modified_time=None, size=None, progress=None):
+        """ progress, if given, is called with the number of bytes of each downloaded chunk """
         request = self.service.files().get_media(fileId=gid)
-        self.__execute_download(request, out_path)
+        # Files bigger than one chunk are downloaded into partial_dir, so they can be resumed by later runs
+        partial = None
+        if self.__partial_dir and modified_time and size and size > self.__chunk_size:
+            partial = PartialDownload(self.__partial_dir, gid, modified_time, size)
+        self.__execute_download(request, 'files.get_media', out_path, partial, progress, size)
 
-    def retrieve_all_files(self):
-        files = []
+    def discard_partial_downloads(self, keep=()):
+        """ Removes the partial downloads of files whose gid is not in keep """
+        if not self.__partial_dir or not self.__partial_dir.exists():
+            return
+        for path in self.__partial_dir.glob('*.json'):
+            if path.stem not in keep:
+                PartialDownload(self.__partial_dir, path.stem, None, None).discard()
+
+    def retrieve_all_files(self, q="", page_size=1000):
+        return [data for page in self.retrieve_file_pages(q, page_size) for data in page]
+
+    def retrieve_file_pages(self, q="", page_size=1000):
+        """ Generator of the pages of files matching q, each one requested when the previous one is consumed """
         page_token = None
         while True:
             request = self.service.files().list(
-                        q="",
+                        q=q,
                         spaces='drive',
-                        fields='nextPageToken, files(id, name, mimeType, trashed, '
-                               'createdTime, modifiedTime, parents, exportLinks)',
+                        pageSize=page_size,
+                        fields='nextPageToken, files(%s)' % FILE_FIELDS,
                         pageToken=page_token
                     )
 
-            response = self.__execute_request(request)
-            files += response.get('files', [])
+            response = self.__execute_request(request, 'files.list')
+            yield response.get('files', [])
             page_token = response.get('nextPageToken', None)
             if page_token is None:
                 break
-        return files
 
-    def __wait_before_request(self):
-        wait = self.__time_request - (time.time() - self.__last_request)
-        if wait > 0:
+    def list_files(self, root_folder=None, workers=4, folders_per_query=50):
+        """ Generator of pages of the root folder and its subtree (or the whole drive without root folder), running up
+        to `workers` queries at once. Trashed files are not listed and each file is listed once """
+        listed = set()
+        for page in self.__list_pages(root_folder, workers, folders_per_query):
+            page = [data for data in page if data['id'] not in listed]
+            listed.update(data['id'] for data in page)
+            yield page
+
+    def find_root_folders(self, name):
+        """ Folders named name at the top of My Drive or without parents (i.e. shared with the user) """
+        root_id = self.__execute_request(self.service.files().get(fileId='root', fields='id'), 'files.get')['id']
+        q = "name = '%s' and mimeType = '%s' and trashed = false" \
+            % (name.replace('\\', '\\\\').replace("'", "\\'"), GMimeTypes.GFOLDER.value)
+        return [data for data in self.retrieve_all_files(q) if data.get('parents', [root_id])[0] == root_id]
+
+    def retrieve_descendants(self, folder_ids, workers=4, folders_per_query=50):
+        """ Generator of pages of the contents of the folders and of all their subfolders. Pending folders are queried
+        in groups of up to folders_per_query with 'in parents' queries """
+        pending = list(folder_ids)
+        seen = set(pending)
+
+        def next_queries(free):
+            queries = []
+            while pending and free:
+                # Groups are kept small while there are few pending folders so every worker gets some
+                size = min(folders_per_query, -(-len(pending) // free))
+                group = pending[:size]
+                del pending[:size]
+                queries.append('(%s) and trashed = false' % ' or '.join("'%s' in parents" % gid for gid in group))
+                free -= 1
+            return queries
+
+        for page in self.__retrieve_concurrently(next_queries, workers):
+            for data in page:
+                if data['mimeType'] == GMimeTypes.GFOLDER.value and data['id'] not in seen:
+                    seen.add(data['id'])
+                    pending.append(data['id'])
+            yield page
+
+    def get_start_page_token(self):
+        return self.__execute_request(self.service.changes().getStartPageToken(),
+                                     'changes.getStartPageToken')['startPageToken']
+
+    def retrieve_changes(self, page_token):
+        """ Returns the changes since page_token and the token from which the next changes should be requested """
+        changes = []
+        while True:
+            request = self.service.changes().list(
+                        pageToken=page_token,
+                        spaces='drive',
+                        includeRemoved=True,
+                        fields='nextPageToken, newStartPageToken, changes(fileId, removed, file(%s))' % FILE_FIELDS
+                    )
+
+            response = self.__execute_request(request, 'changes.list')
+            changes += response.get('changes', [])
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                return changes, response['newStartPageToken']
+
+    def get_files_metadata(self, gids, fields=FILE_FIELDS):
+        """ Metadata of each gid (or the HttpError it failed with), fetched through batch requests """
+        return self.execute_batch([self.service.files().get(fileId=gid, fields=fields) for gid in gids], 'files.get')
+
+    def get_head_revisions(self, gids):
+        """ Id of the last revision of each gid (None if it could not be retrieved). Google files are listed without
+        headRevisionId, so it is taken from their revisions """
+        fields = 'nextPageToken, revisions(id)'
+        results = self.execute_batch([self.service.revisions().list(fileId=gid, fields=fields, pageSize=1000)
+                                      for gid in gids], 'revisions.list')
+        revisions = {}
+        for gid, response in zip(gids, results):
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                # Revisions are listed oldest first
+                while response.get('nextPageToken', None):
+                    request = self.service.revisions().list(fileId=gid, fields=fields, pageSize=1000,
+                                                            pageToken=response['nextPageToken'])
+                    response = self.__execute_request(request, 'revisions.list')
+                revisions[gid] = response['revisions'][-1]['id'] if response.get('revisions', None) else None
+            except Exception as e:
+                print('- Error: Could not retrieve revisions of %s [%s]' % (gid, str(e)))
+                revisions[gid] = None
+        return revisions
+
+    def execute_batch(self, requests, endpoint, batch_size=100):
+        """ Executes requests in batches of up to batch_size calls, each one costing a single round trip. Returns the
+        response or the exception of each request, which are counted under endpoint. Items failing with transient errors
+        are retried in later batches, each one following the retry policy on its own """
+        results = [None] * len(requests)
+        attempts = [0] * len(requests)
+        waited = [0] * len(requests)
+        pending = list(range(len(requests)))
+        while pending:
+            failed = []
+
+            def callback(request_id, response, exception):
+                i = int(request_id)
+                results[i] = exception if exception else response
+                if exception:
+                    failed.append(i)
+
+            for start in range(0, len(pending), batch_size):
+                batch = self.__new_batch(callback)
+                for i in pending[start:start + batch_size]:
+                    self.retry_policy.count(endpoint, 'calls')
+                    batch.add(requests[i], request_id=str(i))
+                self.__execute_request(batch, 'batch')
+
+            pending = []
+            wait = 0
+            for i in sorted(failed):
+                item_wait = self.retry_policy.backoff(endpoint, results[i], attempts[i], waited[i])
+                if item_wait is not None:
+                    attempts[i] += 1
+                    waited[i] += item_wait
+                    pending.append(i)
+                    wait = max(wait, item_wait)
             time.sleep(wait)
-        self.__last_request = time.time()
+        return results
+
+    def __new_batch(self, callback):
+        if self.__root_url:
+            # The batch endpoint is not derived from api_endpoint
+            return BatchHttpRequest(callback=callback, batch_uri=self.__root_url + 'batch/drive/v3')
+        return self.service.new_batch_http_request(callback=callback)
+
+    def __list_pages(self, root_folder, workers, folders_per_query):
+        if root_folder:
+            roots = self.find_root_folders(root_folder)
+            if not roots:
+                print('- Error: Root folder %s was not found' % root_folder)
+            yield roots
+            yield from self.retrieve_descendants([data['id'] for data in roots], workers, folders_per_query)
+            return
+
+        google = [m.value for m in GMimeTypes if m is not GMimeTypes.GPREFIX]
+        splits = ["mimeType = '%s'" % m for m in google] + ["mimeType contains '%s'" % m for m in SPLIT_MIME_TYPES]
+        # The last query gets everything else, so the listing is complete even if splits overlap
+        rest = ' and '.join("mimeType != '%s'" % m for m in google)
+        rest += ''.join(" and not mimeType contains '%s'" % m for m in SPLIT_MIME_TYPES)
+        queries = ['%s and trashed = false' % q for q in splits + [rest]]
+
+        def next_queries(free):
+            taken = queries[:free]
+            del queries[:free]
+            return taken
 
-    def __execute_request(self, request):
-        self.__wait_before_request()
-        return request.execute()
+        yield from self.__retrieve_concurrently(next_queries, workers)
 
-    def __execute_download(self, request, out_path,
-                           retry=10, retry_wait_time_s=1, retry_incremental=1.5, max_retry_time_s=60):
-        self.__wait_before_request()
+    def __retrieve_concurrently(self, next_queries, workers):
+        # Yields pages as worker threads receive them. next_queries(free_workers) is called again after each page is
+        # consumed, so the consumer can add queries based on it
+        pages = queue.Queue()
+        running = 0
+
+        def retrieve(q):
+            try:
+                for page in self.retrieve_file_pages(q):
+                    pages.put(page)
+                pages.put(None)
+            except Exception as e:
+                pages.put(e)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                for q in next_queries(workers - running):
+                    executor.submit(retrieve, q)
+                    running += 1
+                if not running:
+                    return
+                page = pages.get()
+                if page is None:
+                    running -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield page
+
+    def __execute_request(self, request, endpoint):
+        # Endpoints are named explicitly, as media downloads share the method id of metadata requests
+        def execute():
+            self.__limiter.acquire()
+            return request.execute()
+        return self.retry_policy.call(endpoint, execute)
+
+    def __execute_download(self, request, endpoint, out_path, partial=None, progress=None, size=None):
+        def download():
+            self.__limiter.acquire()
+            if partial:
+                self.__download_partial(request, out_path, partial, progress)
+            else:
+                with atomic_write(out_path) as f:
+                    self.__download_chunks(MediaIoBaseDownload(f, request, chunksize=self.__chunk_size), progress)
         try:
-            out_file = io.BytesIO()
-            downloader = MediaIoBaseDownload(out_file, request)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-            with out_path.open('wb') as f:
-                f.write(out_file.getvalue())
+            self.retry_policy.call(endpoint, download)
         except errors.HttpError as e:
-            if e.resp.status == 416:  # Empty file
-                with out_path.open('w'):  # Assert that file is created
+            if e.resp.status == 416 and not size:  # Empty file (Google files have no size)
+                with atomic_write(out_path):  # Assert that file is created
                     pass
-            elif e.resp.status == 500:  # Server error, retry
-                if retry > 0:
-                    assert retry_incremental >= 1
-                    time.sleep(retry_wait_time_s)
-                    retry -= 1
-                    retry_wait_time_s *= retry_incremental
-                    if retry_wait_time_s > max_retry_time_s:
-                        retry_wait_time_s = max_retry_time_s
-                    self.__execute_download(request, out_path, retry, retry_wait_time_s, retry_incremental)
-                else:
-                    raise e
             else:
                 raise e
 
-    def download_export_from_link(self, url, out_path: Path,
-                                  retry=10, retry_wait_time_s=1, retry_incremental=1.5, max_retry_time_s=60):
-        response = requests.get(url, headers={'Authorization': 'Bearer %s' % self.__credentials.token})
+    def __download_partial(self, request, out_path, partial, progress=None):
+        offset = partial.resume_offset()
+        if offset == 0:
+            partial.start()
+        if offset < partial.meta['size']:
+            with partial.data_path.open('ab') as f:
+                downloader = MediaIoBaseDownload(f, request, chunksize=self.__chunk_size)
+                # The downloader requests byte ranges starting from its progress
+                downloader._progress = offset
+                self.__download_chunks(downloader, progress)
+        partial.finish(out_path)
 
-        if response.status_code == 200:
-            with out_path.open('wb') as f:
-                f.write(response.content)
+    @staticmethod
+    def __download_chunks(downloader, progress=None):
+        done = False
+        reported = downloader._progress
+        while not done:
+            status, done = downloader.next_chunk()
+            if progress:
+                progress(status.resumable_progress - reported)
+                reported = status.resumable_progress
 
-        elif response.status_code == 500 and retry > 0:
-            # TODO another syntax for the retry code ? Which is repeated in __execute_download
-            assert retry_incremental >= 1
-            time.sleep(retry_wait_time_s)
-            retry -= 1
-            retry_wait_time_s *= retry_incremental
-            if retry_wait_time_s > max_retry_time_s:
-                retry_wait_time_s = max_retry_time_s
-            self.download_export_from_link(url, out_path, retry, retry_wait_time_s, retry_incremental)
+    def download_export_from_link(self, url, out_path: Path, progress=None):
+        # Only the path of the link is kept with root_url
+        link = self.__root_url + url.split('/', 3)[3] if self.__root_url else url
 
-        else:
-            raise Exception('Could not download file using export url')
+        def download():
+            self.__limiter.acquire()
+            headers = {'Authorization': 'Bearer %s' % self.__credentials.token}
+            with requests.get(link, headers=headers, stream=True) as response:
+                if response.status_code != 200:
+                    raise ExportLinkError(response.status_code, response.headers.get('Retry-After', None))
+                with atomic_write(out_path) as f:
+                    for chunk in response.iter_content(chunk_size=self.__chunk_size):
+                        f.write(chunk)
+                        if progress:
+                            progress(len(chunk))
+        self.retry_policy.call('export_link', download)
 
-    def __build_service(self):
+    def __load_credentials(self):
         self.__credentials = None
 
         # Try to load from pickle
@@ -146,5 +625,3 @@ class GDriveAPI:
 
             with self.__token_pickle_path.open('wb') as f:
                 pickle.dump(self.__credentials, f)
-
-        return build('drive', 'v3', credentials=self.__credentials)
@@ -0,0 +1,118 @@
+import heapq
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+
+class Metrics:
+    """ Thread safe phase timers, counters and download timings of a backup run. A report is written per run as a line
+    of a JSON lines file or as a Prometheus textfile (.prom) """
+
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self.reset()
+
+    def reset(self):
+        self.__lock = threading.Lock()
+        self.__started = time.time()
+        self.__phases = {}
+        self.__counters = {}
+        self.__mime_types = {}
+        self.__files = []  # Heap of the slowest downloads
+
+    @contextmanager
+    def phase(self, name):
+        """ Adds the time spent in the block to the phase. Phases can be entered several times """
+        t_begin = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.__lock:
+                self.__phases[name] = self.__phases.get(name, 0) + time.monotonic() - t_begin
+
+    def count(self, name, value=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def download(self, path, mime_type, size, seconds):
+        """ Records a downloaded (or exported) file of size bytes which took seconds """
+        with self.__lock:
+            counters = self.__mime_types.setdefault(mime_type, {'files': 0, 'bytes': 0, 'seconds': 0})
+            counters['files'] += 1
+            counters['bytes'] += size
+            counters['seconds'] += seconds
+            entry = (seconds, str(path), mime_type, size)
+            if len(self.__files) < self.slowest:
+                heapq.heappush(self.__files, entry)
+            else:
+                heapq.heappushpop(self.__files, entry)
+
+    def report(self, endpoints=None):
+        """ Report of the run. endpoints are the per endpoint counters of RetryPolicy.stats """
+        with self.__lock:
+            mime_types = {}
+            for mime_type, counters in self.__mime_types.items():
+                mime_types[mime_type] = dict(counters)
+                mime_types[mime_type]['bytes_per_s'] = counters['bytes'] / counters['seconds'] \
+                    if counters['seconds'] else 0
+            return {
+                'time': datetime.fromtimestamp(self.__started).strftime('%Y-%m-%dT%H:%M:%S'),
+                'timestamp': self.__started,
+                'duration_s': time.time() - self.__started,
+                'phases': dict(self.__phases),
+                'counters': dict(self.__counters),
+                'endpoints': endpoints or {},
+                'mime_types': mime_types,
+                'slowest': [{'path': path, 'mime_type': mime_type, 'size': size, 'seconds': seconds}
+                            for seconds, path, mime_type, size in sorted(self.__files, reverse=True)],
+            }
+
+    def write(self, path: Path, endpoints=None):
+        report = self.report(endpoints)
+        path.parents[0].mkdir(parents=True, exist_ok=True)
+        if path.suffix == '.prom':
+            # Replaced atomically, as the node exporter textfile collector expects
+            tmp_path = path.with_name('.%s.part' % path.name)
+            tmp_path.write_text(Metrics.to_prometheus(report))
+            os.replace(str(tmp_path), str(path))
+        else:
+            with path.open('a') as f:
+                f.write(json.dumps(report) + '\n')
+
+    def print_phases(self):
+        with self.__lock:
+            phases = sorted(self.__phases.items(), key=lambda item: -item[1])
+        for name, seconds in phases:
+            print('- %-30s %8.1fs' % (name, seconds))
+
+    # Static -----------------------------------------------------------------------------------------------------------
+
+    @staticmethod
+    def to_prometheus(report):
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        lines = ['gdrive_backup_last_run_timestamp_seconds %d' % report['timestamp'],
+                 'gdrive_backup_duration_seconds %f' % report['duration_s']]
+        for name, seconds in sorted(report['phases'].items()):
+            lines.append('gdrive_backup_phase_seconds{phase="%s"} %f' % (label(name), seconds))
+        for name, value in sorted(report['counters'].items()):
+            lines.append('gdrive_backup_count{name="%s"} %s' % (label(name), value))
+        for endpoint, counters in sorted(report['endpoints'].items()):
+            for name, value in sorted(counters.items()):
+                lines.append('gdrive_backup_api_%s{endpoint="%s"} %s' % (name, label(endpoint), value))
+        for mime_type, counters in sorted(report['mime_types'].items()):
+            for name, value in sorted(counters.items()):
+                lines.append('gdrive_backup_download_%s{mime_type="%s"} %s' % (name, label(mime_type), value))
+        for file in report['slowest']:
+            lines.append('gdrive_backup_slowest_download_seconds{path="%s",mime_type="%s",size="%d"} %f'
+                         % (label(file['path']), label(file['mime_type']), file['size'], file['seconds']))
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of the current run, shared by all modules
+metrics = Metrics()
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+from GDriveAPI import atomic_write
+from utils import file_op_decorator, remove_empty_dirs
+
+
+def md5_file(path: Path, chunk_size=1024 * 1024):
+    # Same digest as the md5Checksum of binary files in Drive
+    digest = hashlib.md5()
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RevisionStore:
+    """ Content addressed revisions. Each revised file is stored once as a blob named by its md5, and each run writes a
+    manifest mapping the original paths and gids to their blobs """
+
+    def __init__(self, revisions_dir: Path):
+        self.blobs_dir = revisions_dir / 'blobs'
+        self.manifests_dir = revisions_dir / 'manifests'
+
+    def blob_path(self, key):
+        return self.blobs_dir / key[:2] / key
+
+    def has_blob(self, key):
+        return self.blob_path(key).exists()
+
+    def add(self, path: Path):
+        """ Moves the file at path into the store and returns its key. Duplicated content is just removed """
+        key = md5_file(path)
+        blob = self.blob_path(key)
+        if blob.exists():
+            path.unlink()
+        else:
+            blob.parents[0].mkdir(parents=True, exist_ok=True)
+            shutil.move(str(path), str(blob))
+        return key
+
+    def revise_files(self, base_dir, revision_name, files):
+        fails = []
+        manifest = []
+        left_dirs = set()
+        generator = file_op_decorator(files, '* Moving deleted files', '* Moving deleted files, DONE')
+
+        for file in generator:
+            origin = file.make_relative_path(base_dir)
+            try:
+                if not origin.exists():
+                    raise Exception('%s [File was not found in the backup]' % origin)
+                # Other export formats of Google files are revised along
+                for (_, path), (_, relative) in zip(file.export_paths(base_dir)[1:], file.export_paths()[1:]):
+                    if path.exists():
+                        manifest.append({'path': relative.as_posix(), 'gid': file.gid, 'blob': self.add(path)})
+                key = self.add(origin)
+                left_dirs.add(origin.parents[0])
+                manifest.append({'path': file.make_relative_path().as_posix(), 'gid': file.gid, 'blob': key})
+            except Exception as e:
+                fails.append(e)
+        remove_empty_dirs(left_dirs, base_dir)
+
+        if manifest:
+            # Runs in the same second (i.e. watch mode passes) share the revision, so its manifest is extended
+            self.manifests_dir.mkdir(parents=True, exist_ok=True)
+            manifest_path = self.manifests_dir / ('%s.json' % revision_name)
+            if manifest_path.exists():
+                with manifest_path.open('r') as f:
+                    manifest = json.load(f) + manifest
+            with atomic_write(manifest_path) as f:
+                f.write(json.dumps(manifest, indent=1).encode())
+        for path in fails:
+            print('- Error: %s' % path)
+
+    def list_revisions(self):
+        if not self.manifests_dir.exists():
+            return []
+        return sorted(path.stem for path in self.manifests_dir.glob('*.json'))
+
+    def restore(self, revision_name, out_dir: Path, link=False):
+        """ Rebuilds the files revised in a run under out_dir. With link, blobs are hardlinked instead of copied, so
+        restored files must not be modified """
+        with (self.manifests_dir / ('%s.json' % revision_name)).open('r') as f:
+            manifest = json.load(f)
+        for entry in manifest:
+            out_path = out_dir / entry['path']
+            out_path.parents[0].mkdir(parents=True, exist_ok=True)
+            blob = self.blob_path(entry['blob'])
+            if link and not out_path.exists():
+                os.link(str(blob), str(out_path))
+            else:
+                shutil.copy2(str(blob), str(out_path))
+        return len(manifest)
@@ -0,0 +1,86 @@
+import sqlite3
+from pathlib import Path
+
+from FileTree import FileTree
+from FileTreeNode import StoredFile
+from GDriveAPI import GMimeTypes
+
+SCHEMA_VERSION = 1
+SCHEMA = '''
+CREATE TABLE nodes (
+    gid               TEXT PRIMARY KEY,
+    parent            TEXT,
+    name              TEXT NOT NULL,
+    mime_type         TEXT NOT NULL,
+    created_time      INTEGER,
+    modified_time     INTEGER,
+    size              INTEGER,
+    last_local_update REAL,
+    path              TEXT NOT NULL,
+    md5               TEXT,
+    head_revision     TEXT
+);
+CREATE INDEX nodes_parent ON nodes (parent);
+'''
+COLUMNS = 'gid, parent, name, mime_type, created_time, modified_time, size, last_local_update, path, md5, head_revision'
+PLACEHOLDERS = ', '.join('?' for _ in COLUMNS.split(','))
+
+
+class TreeStore:
+    """ Snapshot of a FileTree in a SQLite database, queried row by row instead of being loaded in memory """
+
+    def __init__(self, path: Path):
+        path.parents[0].mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.__conn = sqlite3.connect(str(path))
+        version = self.__conn.execute('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise Exception('Tree database %s was written by a newer version (schema %d)' % (path, version))
+        if version == 0:
+            # executescript commits pending transactions, so the creation is wrapped explicitly
+            self.__conn.executescript('BEGIN;\n%s\nPRAGMA user_version = %d;\nCOMMIT;' % (SCHEMA, SCHEMA_VERSION))
+
+    def __len__(self):
+        return self.__conn.execute('SELECT COUNT(*) FROM nodes').fetchone()[0]
+
+    @property
+    def all_files(self):
+        """ Iterates the stored files (not folders) without keeping them in memory """
+        rows = self.__conn.execute('SELECT %s FROM nodes WHERE mime_type != ?' % COLUMNS, (GMimeTypes.GFOLDER.value,))
+        return (StoredFile(*row) for row in rows)
+
+    @property
+    def all_folders(self):
+        rows = self.__conn.execute('SELECT %s FROM nodes WHERE mime_type = ?' % COLUMNS, (GMimeTypes.GFOLDER.value,))
+        return (StoredFile(*row) for row in rows)
+
+    def to_json(self):
+        return (StoredFile(*row).to_json() for row in self.__conn.execute('SELECT %s FROM nodes' % COLUMNS))
+
+    def save(self, tree: FileTree):
+        """ Replaces the snapshot with tree in a single transaction, so a failure keeps the previous snapshot """
+        with self.__conn:
+            self.__conn.execute('DELETE FROM nodes')
+            self.__conn.executemany('INSERT INTO nodes (%s) VALUES (%s)' % (COLUMNS, PLACEHOLDERS),
+                                    (TreeStore.__row(node) for node in tree.all_nodes))
+
+    def update(self, nodes, removed_gids):
+        """ Writes nodes and deletes the rows of removed_gids in a single transaction, for trees changed in place """
+        with self.__conn:
+            self.__conn.executemany('DELETE FROM nodes WHERE gid = ?', ((gid,) for gid in removed_gids))
+            self.__conn.executemany('INSERT OR REPLACE INTO nodes (%s) VALUES (%s)' % (COLUMNS, PLACEHOLDERS),
+                                    (TreeStore.__row(node) for node in nodes))
+
+    def migrate(self, pickle_path: Path):
+        """ One-off import of a tree pickled by versions before the tree database """
+        self.save(FileTree.loader(pickle_path))
+
+    def close(self):
+        self.__conn.close()
+
+    # Private ----------------------------------------------------------------------------------------------------------
+
+    @staticmethod
+    def __row(node):
+        return (node.gid, node.parent_gid, node.name, node.mime_type, node.created_time, node.modified_time, node.size,
+                node.last_local_update, node.make_relative_path().as_posix(), node.md5, node.head_revision)
@@ -0,0 +1,77 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class Watcher:
+    """ Runs sync passes until stopped: a quick pass every interval_s and a full pass every full_interval_s, the first
+    pass being a full one. sync(full) is called from the thread which runs the watcher. With webhook_port, a POST to
+    that local port starts a quick pass at once, as a stand-in for Drive push notifications """
+
+    def __init__(self, sync, interval_s=60, full_interval_s=24 * 3600, webhook_port=None):
+        self.sync = sync
+        self.interval_s = interval_s
+        self.full_interval_s = full_interval_s
+        self.webhook_port = webhook_port
+        self.__wake = threading.Event()
+        self.__stop = threading.Event()
+        self.__server = None
+
+    def run(self):
+        if self.webhook_port is not None:
+            self.__start_webhook()
+        try:
+            next_full = 0
+            while not self.__stop.is_set():
+                full = time.monotonic() >= next_full
+                if full:
+                    next_full = time.monotonic() + self.full_interval_s
+                try:
+                    self.sync(full)
+                except Exception as e:
+                    # The local backup may not match the tree anymore, so it is checked by the next pass
+                    print('- Error: %s pass failed [%s]' % ('Full' if full else 'Quick', str(e)))
+                    next_full = 0
+                self.__wake.wait(self.interval_s)
+                self.__wake.clear()
+        finally:
+            if self.__server:
+                self.__server.shutdown()
+                self.__server.server_close()
+
+    def wake(self):
+        """ Starts the next pass without waiting for the interval. Calls during a pass start a single pass after it """
+        self.__wake.set()
+
+    def stop(self):
+        self.__stop.set()
+        self.__wake.set()
+
+    # Private ----------------------------------------------------------------------------------------------------------
+
+    def __start_webhook(self):
+        self.__server = WebhookServer(('127.0.0.1', self.webhook_port), WebhookHandler)
+        self.__server.watcher = self
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        print('Listening for change notifications on port %d' % self.__server.server_address[1])
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """ Accepts change notifications as posted by Drive to a channel (changes.watch). Any POST wakes the watcher, except
+    the sync message sent when a channel is created """
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        if self.headers.get('X-Goog-Resource-State', None) != 'sync':
+            self.server.watcher.wake()
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,282 @@
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from pathlib import Path
+
+from google.oauth2.credentials import Credentials
+
+from FakeDrive import FakeDrive
+from FileTree import FileTree
+from FileTreeNode import FileTreeNode as Node, parse_time
+from GDriveAPI import GMimeTypes, EXPORT_LINKS
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+
+
+def synthetic_nodes(n, files_per_folder=50, seed=0):
+    """ Create n linked nodes (folders and files) shaped like a Drive tree """
+    rnd = random.Random(seed)
+    root = Node('root', 'root', GMimeTypes.GFOLDER.value, '2020-01-01T00:00:00.000Z', '2020-01-01T00:00:00.000Z')
+    folders = [root]
+    nodes = [root]
+    for i in range(1, n):
+        parent = rnd.choice(folders)
+        if i % files_per_folder == 0:
+            node = Node('d%07d' % i, 'dir%d' % i, GMimeTypes.GFOLDER.value,
+                        '2020-01-01T00:00:00.000Z', '2020-01-01T00:00:00.000Z', parent)
+            folders.append(node)
+        else:
+            node = Node('f%07d' % i, 'file%d.bin' % i, 'application/octet-stream',
+                        '2020-01-01T00:00:00.000Z', '2020-01-01T00:00:00.000Z', parent)
+        parent.children.append(node)
+        nodes.append(node)
+    return nodes
+
+
+def random_time(rnd):
+    return '20%02d-%02d-%02dT%02d:%02d:%02d.%03dZ' % (rnd.randrange(10, 25), rnd.randrange(1, 13), rnd.randrange(1, 29),
+                                                    rnd.randrange(24), rnd.randrange(60), rnd.randrange(60),
+                                                    rnd.randrange(1000))
+
+
+def synthetic_listing(n, files_per_folder=50, seed=0):
+    """ Create n JSON entries as returned by the Drive listing, shuffled so parents may follow their children """
+    rnd = random.Random(seed)
+    folders = ['root']
+    files = [{'id': 'root', 'name': 'root', 'mimeType': GMimeTypes.GFOLDER.value, 'trashed': False,
+              'createdTime': '2020-01-01T00:00:00.000Z', 'modifiedTime': '2020-01-01T00:00:00.000Z'}]
+    for i in range(1, n):
+        is_folder = i % files_per_folder == 0
+        is_doc = i % 5 == 0 and not is_folder
+        gid = ('d%07d' if is_folder else 'f%07d') % i
+        files.append({'id': gid, 'name': ('dir%d' if is_folder else 'file%d.bin') % i,
+                      'mimeType': GMimeTypes.GFOLDER.value if is_folder else 'application/octet-stream',
+                      'trashed': False, 'parents': [rnd.choice(folders)], 'size': str(rnd.randrange(1 << 24)),
+                      'createdTime': random_time(rnd), 'modifiedTime': random_time(rnd)})
+        if is_folder:
+            folders.append(gid)
+        if is_doc:
+            # Google files come without size but with a few export links in the listing
+            del files[-1]['size']
+            files[-1]['mimeType'] = GMimeTypes.GDOCS.value
+            files[-1]['exportLinks'] = {m: EXPORT_LINKS[GMimeTypes.GDOCS.value] % (gid, m.split('/')[-1])
+                                        for m in ['application/pdf', 'text/plain', 'application/rtf', 'text/html']}
+    rnd.shuffle(files)
+    return files
+
+
+def tree_from_nodes(nodes):
+    tree = FileTree()
+    tree.all_nodes = nodes
+    tree.all_files = [f for f in nodes if f.is_file()]
+    tree.all_folders = [f for f in nodes if f.is_google_folder()]
+    tree.roots = [f for f in nodes if not f.parent]
+    tree.index = {f.gid: f for f in nodes}
+    return tree
+
+
+def mutate(nodes, ratio=0.01, seed=1):
+    """ Copy of nodes where a fraction of files is modified, deleted or added """
+    rnd = random.Random(seed)
+    copies = {}
+    for node in nodes:
+        parent = copies[node.parent.gid] if node.parent else None
+        copy = Node(node.gid, node.name, node.mime_type, node.created_time, node.modified_time, parent)
+        if parent:
+            parent.children.append(copy)
+        copies[node.gid] = copy
+    result = []
+    for copy in copies.values():
+        r = rnd.random()
+        if copy.is_file() and r < ratio:
+            continue  # Deleted
+        if copy.is_file() and r < 2 * ratio:
+            copy.modified_time = parse_time('2021-01-01T00:00:00.000Z')
+        result.append(copy)
+    for i in range(int(len(nodes) * ratio)):
+        result.append(Node('n%07d' % i, 'new%d.bin' % i, 'application/octet-stream',
+                           '2021-01-01T00:00:00.000Z', '2021-01-01T00:00:00.000Z', copies['root']))
+    return result
+
+
+def bench_diff(sizes):
+    print('%-10s %-12s %-12s %-12s %s' % ('nodes', 'download', 'revision', 'move', 'diff time'))
+    for n in sizes:
+        old_nodes = synthetic_nodes(n)
+        old_tree = tree_from_nodes(old_nodes)
+        new_tree = tree_from_nodes(mutate(old_nodes))
+        t_begin = time.perf_counter()
+        to_download, to_revision, to_move = FileTree.diff(old_tree, new_tree)
+        elapsed = time.perf_counter() - t_begin
+        print('%-10d %-12d %-12d %-12d %.3fs' % (n, len(to_download), len(to_revision), len(to_move), elapsed))
+
+
+def bench_build(sizes):
+    print('%-10s %-12s %s' % ('nodes', 'kept', 'build time'))
+    for n in sizes:
+        files = synthetic_listing(n)
+        t_begin = time.perf_counter()
+        tree = FileTree(files, root_folder='root')
+        elapsed = time.perf_counter() - t_begin
+        print('%-10d %-12d %.3fs' % (n, len(tree.all_nodes), elapsed))
+
+
+class LegacyNode(object):
+    """ Node layout before slots: plain attributes, ISO time strings and export links copied from the listing """
+
+    def __init__(self, data, parent=None):
+        self.gid = data['id']
+        self.name = data['name']
+        self.mime_type = data['mimeType']
+        self.created_time = data['createdTime']
+        self.modified_time = data['modifiedTime']
+        self.last_local_update = None
+        self.export_links = dict(data['exportLinks']) if 'exportLinks' in data else []
+        self.size = int(data['size']) if 'size' in data else None
+        self.parent = parent
+        self.children = []
+
+
+def measure_memory(build):
+    """ Bytes still allocated by the objects returned by build """
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def bench_memory(sizes):
+    print('%-10s %-14s %-14s %s' % ('nodes', 'legacy', 'slots', 'ratio'))
+    for n in sizes:
+        files = synthetic_listing(n)
+        legacy = measure_memory(lambda: [LegacyNode(f) for f in files])
+        slots = measure_memory(lambda: [Node.from_json(f) for f in files])
+        print('%-10d %-14s %-14s %.2f' % (n, '%.1f MB' % (legacy / 1e6), '%.1f MB' % (slots / 1e6), slots / legacy))
+
+
+def legacy_relative_path(node):
+    """ Path computation before folder paths were cached: one Path per ancestor on every call """
+    path = Path('')
+    current = node.parent
+    while current:
+        path = Path(current.name) / path
+        current = current.parent
+    return path / node.name
+
+
+def bench_paths(sizes, depth=30, calls=5):
+    print('%-10s %-14s %-14s %s' % ('nodes', 'legacy', 'cached', 'speedup'))
+    for n in sizes:
+        # Folders chained in runs of `depth` levels, so most files are deep in the hierarchy
+        nodes = synthetic_nodes(n)
+        folders = [f for f in nodes if f.is_google_folder()]
+        for i, folder in enumerate(folders[1:], start=1):
+            folder.parent.children.remove(folder)
+            folder.parent = folders[i - 1] if i % depth else folders[0]
+            folder.parent.children.append(folder)
+        files = [f for f in nodes if f.is_file()]
+
+        t_begin = time.perf_counter()
+        for _ in range(calls):
+            legacy = [legacy_relative_path(f) for f in files]
+        legacy_time = time.perf_counter() - t_begin
+        t_begin = time.perf_counter()
+        for _ in range(calls):
+            cached = [f.make_relative_path() for f in files]
+        cached_time = time.perf_counter() - t_begin
+        assert legacy == cached
+        print('%-10d %-14s %-14s %.1fx' % (n, '%.3fs' % legacy_time, '%.3fs' % cached_time, legacy_time / cached_time))
+
+
+def write_fake_config(directory: Path, drive: FakeDrive, request_rate):
+    """ Configuration of a backup of the FakeDrive root folder into directory, with a token that needs no login """
+    saves = directory / 'saves'
+    saves.mkdir(parents=True, exist_ok=True)
+    with (saves / 'token.pickle').open('wb') as f:
+        pickle.dump(Credentials(token='fake'), f)
+    config = {'root_folder': 'Backup', 'backup_dir': str(directory / 'backup'),
+              'revisions_dir': str(directory / 'revisions'), 'credentials': str(directory / 'credentials.json'),
+              'tree_pickle': str(saves / 'tree.pickle'), 'token_pickle': str(saves / 'token.pickle'),
+              'scopes': [], 'api_root_url': drive.root_url, 'requests_per_second': request_rate,
+              'metrics_file': str(saves / 'metrics.jsonl')}
+    config_path = directory / 'config.json'
+    config_path.write_text(json.dumps(config))
+    return config_path
+
+
+def run_backup_process(config_path: Path, results):
+    # Runs in its own process so the peak RSS is the one of the backup alone
+    import run_backup
+    run_backup.CONFIG_PATH = config_path
+    t_begin = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        run_backup.main()
+    elapsed = time.perf_counter() - t_begin
+    try:
+        import resource  # Not available on Windows
+        results.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+    except ImportError:
+        results.put((elapsed, None))
+
+
+def bench_backup(sizes, latency_s=0, error_rate=0, request_rate=1000):
+    """ Full backup, incremental backup after changing 1% of the files and backup after moving half of the folders,
+    against a FakeDrive """
+    print('%-10s %-12s %-10s %-10s %-12s %s' % ('nodes', 'scenario', 'time', 'requests', 'downloaded', 'peak RSS'))
+    context = multiprocessing.get_context('spawn')
+    for n in sizes:
+        errors = {429: error_rate / 3, 500: error_rate / 3, 403: error_rate / 3} if error_rate else None
+        with FakeDrive(latency_s=latency_s, errors=errors) as drive, tempfile.TemporaryDirectory() as tmp:
+            drive.populate(n, root_name='Backup')
+            config_path = write_fake_config(Path(tmp), drive, request_rate)
+            for scenario, prepare in (('full', None), ('incremental', drive.mutate), ('mass move', drive.move_folders)):
+                if prepare:
+                    prepare()
+                drive.requests.clear()
+                results = context.Queue()
+                process = context.Process(target=run_backup_process, args=(config_path, results))
+                process.start()
+                elapsed, peak_rss = results.get()
+                process.join()
+                with (Path(tmp) / 'saves' / 'metrics.jsonl').open('r') as f:
+                    report = json.loads(f.readlines()[-1])
+                downloaded = '%.1f MB' % (report['counters']['downloaded_bytes'] / 1e6)
+                rss = '%.1f MB' % (peak_rss / 1e6) if peak_rss is not None else 'n/a'
+                print('%-10d %-12s %-10s %-10d %-12s %s'
+                      % (n, scenario, '%.2fs' % elapsed, sum(drive.requests.values()), downloaded, rss))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GDrive-Backup synthetic benchmarks')
+    parser.add_argument('benchmark', choices=['diff', 'build', 'memory', 'paths', 'backup'])
+    parser.add_argument('--sizes', type=int, nargs='+')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to each request (backup)')
+    parser.add_argument('--error-rate', type=float, default=0, help='ratio of requests failing (backup)')
+    args = parser.parse_args()
+
+    if args.benchmark == 'diff':
+        bench_diff(args.sizes or DEFAULT_SIZES)
+    elif args.benchmark == 'build':
+        bench_build(args.sizes or DEFAULT_SIZES)
+    elif args.benchmark == 'memory':
+        bench_memory(args.sizes or [500000])
+    elif args.benchmark == 'paths':
+        bench_paths(args.sizes or [10000, 50000])
+    elif args.benchmark == 'backup':
+        bench_backup(args.sizes or [1000, 10000], args.latency, args.error_rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import argparse
+import json
+from pathlib import Path
+
+from RevisionStore import RevisionStore
+from run_backup import CONFIG_PATH
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Restore the files revised by a backup run from the deduplicated '
+                                                 'revisions store (revisions_dedup option)')
+    parser.add_argument('revision', nargs='?', help='revision to restore (i.e. 2020-01-31_02-00-00)')
+    parser.add_argument('out_dir', nargs='?', type=Path, help='folder where files are restored')
+    parser.add_argument('--link', action='store_true', help='hardlink files instead of copying them')
+    args = parser.parse_args()
+
+    try:
+        with CONFIG_PATH.open('r') as f:
+            revisions_dir = Path(json.load(f)['revisions_dir'])
+    except (FileNotFoundError, KeyError, json.JSONDecodeError) as e:
+        print('Could not read revisions_dir from configuration file at \'%s\'. %s.' % (CONFIG_PATH, e))
+        return
+
+    store = RevisionStore(revisions_dir)
+    if not args.revision or not args.out_dir:
+        print('Available revisions:')
+        for name in store.list_revisions():
+            print('- %s' % name)
+        return
+
+    try:
+        count = store.restore(args.revision, args.out_dir, args.link)
+    except FileNotFoundError as e:
+        print('Could not restore revision %s. %s.' % (args.revision, e))
+        return
+    print('Restored %d files of revision %s into %s' % (count, args.revision, args.out_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,24 @@
+import argparse
 import json
 import datetime
 from pathlib import Path
 
+from apiclient import errors
+
+from DownloadScheduler import DownloadScheduler
 from FileTree import FileTree
-from GDriveAPI import GDriveAPI
+from FileTreeNode import set_export_formats
+from GDriveAPI import GDriveAPI, RetryPolicy
+from Metrics import metrics
+from TreeStore import TreeStore
+from Watcher import Watcher
 
 # Setting root folder will prevent the backup of indexing orphaned folders and their contents (otherwise set to None)
 CONFIG_PATH = Path('../config/config.json')
 __VERSION__ = '0.1.1-alpha'
 
 
-def main():
+def main(watch=False):
     print('Backup: %s' % datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     print('Version %s' % __VERSION__)
 
@@ -22,9 +30,31 @@ def main():
             backup_dir    = Path(config['backup_dir'])
             credentials   = Path(config['credentials'])
             revisions_dir = Path(config['revisions_dir'])
+            dedup         = config.get('revisions_dedup', False)
             tree_pickle   = Path(config['tree_pickle'])
+            tree_db       = Path(config.get('tree_db', tree_pickle.with_suffix('.sqlite')))
             token_pickle  = Path(config['token_pickle'])
             scopes        = config['scopes']
+            incremental   = config.get('incremental', True)
+            scheduler     = DownloadScheduler(workers=config.get('download_workers', 4),
+                                              big_workers=config.get('big_file_workers', 1),
+                                              big_file_size=config.get('big_file_size', 100 * 1024 * 1024),
+                                              byte_budget=config.get('download_byte_budget', None),
+                                              time_budget_s=config.get('download_time_budget_s', None))
+            scan_workers  = config.get('scan_workers', 4)
+            list_workers  = config.get('list_workers', 4)
+            request_rate  = config.get('requests_per_second', 10)
+            chunk_size    = config.get('download_chunk_size', 10 * 1024 * 1024)
+            retry_policy  = RetryPolicy(retries=config.get('max_retries', 10),
+                                        deadline_s=config.get('retry_deadline_s', 600))
+            changes_token = Path(config.get('changes_token', tree_pickle.parent / 'changes_token.txt'))
+            partial_dir   = Path(config.get('partial_dir', tree_pickle.parent / 'partial'))
+            metrics_file  = Path(config.get('metrics_file', tree_pickle.parent / 'metrics.jsonl'))
+            api_root_url  = config.get('api_root_url', None)
+            watch_interval_s      = config.get('watch_interval_s', 60)
+            full_check_interval_s = config.get('full_check_interval_s', 24 * 3600)
+            webhook_port          = config.get('webhook_port', None)
+            set_export_formats(config.get('export_formats', {}))
     except FileNotFoundError as e:
         print('Could not read configuration file at \'%s\'. %s.' % (CONFIG_PATH, e))
         return
@@ -34,31 +64,132 @@ def main():
     except json.JSONDecodeError:
         print('Configuration file is malformed.')
         return
+    except ValueError as e:
+        print('Configuration file at \'%s\' is not valid. %s.' % (CONFIG_PATH, e))
+        return
 
     # Backup app -------------------------------------------------------------------------------------------------------
-    api = GDriveAPI(credentials, token_pickle, scopes)
+    api = GDriveAPI(credentials, token_pickle, scopes, request_rate, chunk_size, partial_dir, retry_policy,
+                    api_root_url)
 
-    print('Retrieving all files. This may take a while ...')
-    files = api.retrieve_all_files()
+    print('Opening old tree ...')
+    migrate = not tree_db.exists() and tree_pickle.exists()
+    with metrics.phase('open_tree'):
+        store = TreeStore(tree_db)
+        if migrate:
+            print('Migrating old tree from %s to %s ...' % (tree_pickle, tree_db))
+            store.migrate(tree_pickle)
+    if not len(store):
+        print('Tree is empty. If this is the first time executing the backup, this is normal behavior.')
 
-    print('Building file tree ...')
-    new_tree = FileTree(files, root_folder)
+    # The tree and the changes cursor of the last pass are kept in memory between passes in watch mode
+    state = {'tree': store, 'token': changes_token.read_text().strip() if changes_token.exists() else None}
 
-    print('Loading old tree ...')
-    try:
-        old_tree = FileTree.loader(tree_pickle)
-    except FileNotFoundError:
-        old_tree = FileTree()
-        print('Tree file not found. If this is the first time executing the backup, this is normal behavior.')
+    def sync(full):
+        """ Backup pass. Quick passes only apply the changes since the previous pass, if any, without checking the local
+        backup. Full passes check it and, unless incremental is disabled, also start from the changes. Metrics are
+        reported for the time since the previous report """
+        old_tree = state['tree']
+        new_tree = None
+        if watch and full:
+            print('Full pass: %s' % datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        if (incremental or not full) and len(old_tree) and state['token']:
+            if full:
+                print('Retrieving changes since last backup ...')
+            try:
+                with metrics.phase('changes'):
+                    changes, start_page_token = api.retrieve_changes(state['token'])
+                if not changes and not full:
+                    return
+                if not full:
+                    print('Changes pass: %s' % datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                metrics.count('changes', len(changes))
+                if full or not isinstance(old_tree, FileTree):
+                    print('Building file tree from %d changes ...' % len(changes))
+                    with metrics.phase('build_tree'):
+                        new_tree = FileTree.from_changes(old_tree, changes, api, root_folder)
+            except errors.HttpError as e:
+                print('Could not retrieve changes [HTTP Error %s]. Falling back to a full listing.' % e.resp.status)
+                changes = None
+            if changes and new_tree is None:
+                # The tree kept in memory since the previous pass is patched instead of being rebuilt
+                quick_pass(old_tree, changes, start_page_token)
+                return
+
+        if new_tree is None:
+            # The start page token is requested before listing so changes made while listing are not lost
+            start_page_token = api.get_start_page_token()
+
+            print('Retrieving all files and building file tree. This may take a while ...')
+            # Listing and building overlap, so they are timed as a single phase
+            with metrics.phase('list_and_build_tree'):
+                new_tree = FileTree(root_folder=root_folder, pages=api.list_files(root_folder, list_workers))
+
+        print('Updating backup ...')
+        FileTree.update_dir(old_tree, new_tree, api, backup_dir, revisions_dir, scheduler, scan_workers, dedup,
+                            check_local=full)
+
+        print('Saving new tree for next backup ...')
+        with metrics.phase('save_tree'):
+            store.save(new_tree)
+            changes_token.write_text(start_page_token)
+        state['tree'] = new_tree
+        state['token'] = start_page_token
+        report()
 
-    print('Updating backup ...')
-    old_tree.update_dir(new_tree, api, backup_dir, revisions_dir)
+    def quick_pass(tree, changes, start_page_token):
+        """ Applies the changes to the tree kept in memory and saves only the changed nodes, so the cost of the pass
+        does not depend on the size of the tree """
+        try:
+            print('Applying %d changes to file tree ...' % len(changes))
+            with metrics.phase('build_tree'):
+                snapshot, changed, removed = tree.apply_changes(changes, api, root_folder)
 
-    print('Saving new tree for next backup ...')
-    FileTree.saver(new_tree, tree_pickle)
+            print('Updating backup ...')
+            FileTree.update_dir(snapshot, tree, api, backup_dir, revisions_dir, scheduler, scan_workers, dedup,
+                                check_local=False, changed=changed)
 
-    print()
+            print('Saving %d changed and %d removed nodes for next backup ...' % (len(changed), len(removed)))
+            with metrics.phase('save_tree'):
+                store.update(changed, removed)
+                changes_token.write_text(start_page_token)
+        except Exception:
+            # The tree in memory may be partially patched, so the next pass starts again from the saved tree
+            state['tree'] = store
+            raise
+        state['token'] = start_page_token
+        report()
+
+    def report():
+        print('API requests:')
+        for endpoint, counters in sorted(api.retry_policy.stats().items()):
+            print('- %-30s %6d calls, %4d retries, %4d throttled, %6.1fs waiting'
+                  % (endpoint, counters['calls'], counters['retries'], counters['throttles'], counters['wait_s']))
+
+        print('Phases:')
+        metrics.print_phases()
+        metrics.write(metrics_file, api.retry_policy.stats())
+        metrics.reset()
+        api.retry_policy.reset_stats()
+
+        print()
+
+    if not watch:
+        sync(full=True)
+        store.close()
+        return
+
+    print('Watching changes every %ds, checking the whole backup every %ds ...'
+          % (watch_interval_s, full_check_interval_s))
+    try:
+        Watcher(sync, watch_interval_s, full_check_interval_s, webhook_port).run()
+    except KeyboardInterrupt:
+        print('Stopped')
+    finally:
+        store.close()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--watch', action='store_true', help='keep running, applying the changes as they happen')
+    main(parser.parse_args().watch)
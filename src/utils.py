@@ -1,8 +1,14 @@
+import heapq
+import os
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterable, List, Tuple
 
 from FileTreeNode import FileTreeNode
+from GDriveAPI import ATOMIC_WRITE_TMP
 
 
 def time_to_str(seconds):
@@ -18,6 +24,14 @@ def time_to_str(seconds):
     return '{:02d}h {:02d}m {:02d}s'.format(h, m, s)
 
 
+def size_to_str(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024
+    return '%.1f TiB' % size
+
+
 def file_op_decorator(files: List[FileTreeNode], progress_msg='Progress', complete_msg='Done'):
     """ Generator that prints progress for a list of files of type FileTreeNode """
     t_begin = time.time()
@@ -32,16 +46,124 @@ def file_op_decorator(files: List[FileTreeNode], progress_msg='Progress', comple
     print('\r%s. Took: %s' % (complete_msg, time_to_str(time.time() - t_begin)))
 
 
-def recursive_rmdir_parents(directory: Path, end=None):
-    if end and directory == end:
-        return
-    if is_empty(directory):
-        directory.rmdir()
-    if directory.parents:
-        recursive_rmdir_parents(directory.parents[0], end)
+class ByteProgress:
+    """ Thread safe progress of a set of files, with the ETA computed from the bytes received and the throughput
+    instead of the number of files """
+
+    def __init__(self, files, progress_msg='Progress', complete_msg='Done', interval_s=0.5):
+        self.total_files = len(files)
+        self.total_bytes = sum(file.size or 0 for file in files)
+        self.files_done = 0
+        self.bytes_done = 0
+        self.__progress_msg = progress_msg
+        self.__complete_msg = complete_msg
+        self.__interval_s = interval_s
+        self.__received = {}
+        self.__lock = threading.Lock()
+        self.__t_begin = time.time()
+        self.__t_print = 0
+
+    def update(self, file, n):
+        """ Adds n bytes received for file. Bytes beyond the known size of the file are not counted """
+        with self.__lock:
+            received = self.__received.get(file.gid, 0)
+            n = min(n, max((file.size or 0) - received, 0))
+            self.__received[file.gid] = received + n
+            self.bytes_done += n
+            self.__print(file)
+
+    def done(self, file):
+        # Bytes not reported (i.e. resumed from a previous run) are counted once the file is complete
+        with self.__lock:
+            self.bytes_done += (file.size or 0) - self.__received.pop(file.gid, 0)
+            self.files_done += 1
+            self.__print(file, force=True)
+
+    def close(self):
+        print('\r%s. Took: %s%s' % (self.__complete_msg, time_to_str(time.time() - self.__t_begin), ' ' * 40))
+
+    def __print(self, file, force=False):
+        now = time.time()
+        if not force and now - self.__t_print < self.__interval_s:
+            return
+        self.__t_print = now
+        elapsed = now - self.__t_begin
+        remain = (self.total_bytes - self.bytes_done) * elapsed / self.bytes_done if self.bytes_done else 0
+        print('\r%s... %d/%d, %s/%s [%s] (%s)%s' % (self.__progress_msg, self.files_done, self.total_files,
+                                                    size_to_str(self.bytes_done), size_to_str(self.total_bytes),
+                                                    time_to_str(max(remain, 0)), str(file), ' ' * 10), end='')
+
+
+def scan_dir(base_dir: Path, workers=1) -> Dict[str, Tuple[int, float]]:
+    """ Walks base_dir once and returns (size, mtime) of every file by its posix path relative to base_dir. Directories
+    are taken from a shared queue by up to `workers` threads, so the work is spread whatever the shape of the tree.
+    Temporary files left by interrupted writes are removed instead of being returned """
+    if not base_dir.is_dir():
+        return {}
+    pending = queue.Queue()
+    pending.put('')
+    errors = []
+    removed = []
+
+    def scan():
+        files = {}
+        while True:
+            relative = pending.get()
+            if relative is None:
+                return files
+            try:
+                with os.scandir(os.path.join(str(base_dir), relative)) as it:
+                    for entry in it:
+                        path = relative + '/' + entry.name if relative else entry.name
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.put(path)
+                        elif ATOMIC_WRITE_TMP.match(entry.name):
+                            os.remove(entry.path)
+                            removed.append(path)
+                        else:
+                            st = entry.stat(follow_symlinks=False)
+                            files[path] = (st.st_size, st.st_mtime)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                pending.task_done()
+
+    result = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(scan) for _ in range(workers)]
+        pending.join()
+        for _ in futures:
+            pending.put(None)
+        for future in futures:
+            result.update(future.result())
+    if errors:
+        raise errors[0]
+    if removed:
+        print('- Removed %d temporary files left by interrupted runs' % len(removed))
+    return result
+
+
+def remove_empty_dirs(directories: Iterable[Path], end: Path):
+    """ Removes the directories which are empty and then their parents which become empty, up to end (not included).
+    Each directory is checked once, deepest first """
+    seen = set()
+    pending = []
+
+    def push(directory):
+        if directory not in seen and end in directory.parents:
+            seen.add(directory)
+            heapq.heappush(pending, (-len(directory.parts), directory))
+
+    for directory in directories:
+        push(directory)
+    while pending:
+        _, directory = heapq.heappop(pending)
+        if directory.is_dir() and is_empty(directory):
+            directory.rmdir()
+            push(directory.parents[0])
 
 
 def is_empty(directory: Path):
     for _ in directory.iterdir():
         return False
-    return False
+    return True